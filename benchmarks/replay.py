@@ -0,0 +1,412 @@
+"""Нагрузочный прогон путей архивации и задач на синтетических апдейтах.
+
+Апдейты (текст, задачи боту, /tasks, кнопки, фото, голосовые, пересылки,
+ответы) идут через те же хендлеры и PerChatUpdateProcessor, что и в боте,
+с заданной частотой. Bot API подменен заглушкой в процессе, модель -
+заглушкой с заданным real-time factor. Нужна одноразовая база Postgres:
+
+    docker run -d --rm -p 5434:5432 -e POSTGRES_PASSWORD=bench -e POSTGRES_DB=bench postgres:15-alpine
+    PG_HOST=127.0.0.1 PG_PORT=5434 PG_DBNAME=bench PG_USER=postgres PG_PASSWORD=bench \\
+        python -m benchmarks.replay --fresh --updates 500 --rate 200
+
+Для каждого сценария печатает пропускную способность, p50/p95/p99
+времени обработки апдейта и число SQL-выражений по видам.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from tools.fake_telegram import FakeBotApi, BOT_USERNAME
+
+SCENARIOS = ('text', 'reply', 'forward', 'task', 'tasks', 'callback', 'photo', 'voice', 'mixed')
+MIXED_WEIGHTS = {'text': 60, 'reply': 10, 'forward': 5, 'task': 5, 'tasks': 3, 'callback': 5, 'photo': 7, 'voice': 5}
+VOICE_SECONDS = 5
+BOT_ID = 1
+
+
+def configure_env() -> None:
+    # До импорта бота: модули читают настройки при импорте
+    os.environ.setdefault('TOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('LOCAL_PATH', tempfile.mkdtemp(prefix='bench_media_'))
+    os.environ['TRANSCRIPTION_MODE'] = 'inline'
+    os.environ['WHISPER_PRELOAD'] = 'off'
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['METRICS_PORT'] = '0'
+
+
+def drop_schema() -> None:
+    import psycopg2
+    dbname = os.getenv('PG_DBNAME', '')
+    if 'bench' not in dbname and 'test' not in dbname:
+        sys.exit(f'--fresh удаляет схему bot_data: база {dbname!r} не похожа на одноразовую (нужно bench/test в имени)')
+    conn = psycopg2.connect(host=os.getenv('PG_HOST'), port=os.getenv('PG_PORT'), dbname=dbname,
+                            user=os.getenv('PG_USER'), password=os.getenv('PG_PASSWORD'))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS bot_data CASCADE; DROP SCHEMA IF EXISTS bot_archive CASCADE;')
+    conn.close()
+
+
+# --- Подсчет SQL-выражений ---
+
+STATEMENTS = Counter()
+_statements_lock = threading.Lock()
+_TABLE_RE = re.compile(r'\b(?:INTO|FROM|UPDATE|TABLE)\s+([\w.]+)', re.IGNORECASE)
+
+
+def statement_kind(sql) -> str:
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    sql = re.sub(r'--[^\n]*', '', str(sql)).strip()
+    verb = sql.split(None, 1)[0].upper() if sql else '?'
+    table = _TABLE_RE.search(sql)
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+def install_statement_counter(database) -> None:
+    """Подменяет соединения пула на считающие каждое cur.execute"""
+    from psycopg2.extensions import cursor
+
+    class CountingCursor(cursor):
+        def execute(self, query, vars=None):
+            with _statements_lock:
+                STATEMENTS[statement_kind(query)] += 1
+            return super().execute(query, vars)
+
+    class CountingConnection(database.PooledConnection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.cursor_factory = CountingCursor
+
+    database.PooledConnection = CountingConnection
+    # Если пул уже создан - пересоздастся с новыми соединениями
+    pool, database.db.pg._pool = database.db.pg._pool, None
+    if pool is not None:
+        pool.closeall()
+
+
+# --- Заглушки Bot API и модели ---
+
+def make_stub_request():
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        """Bot API в процессе: без сети, ответы как у tools/fake_telegram.py"""
+
+        def __init__(self):
+            self.api = FakeBotApi()
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            if '/file/bot' in url:
+                return 200, self.api.voice
+            params = request_data.parameters if request_data is not None else {}
+            result = self.api.call(url.rsplit('/', 1)[-1], params)
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return StubRequest()
+
+
+def install_stub_engine(media_saver, rtf: float) -> None:
+    import numpy as np
+    from services import media_worker
+    from services.audio import SAMPLE_RATE
+    from services.engines import TranscriptionEngine
+
+    class StubEngine(TranscriptionEngine):
+        """Спит rtf * длительность записи, как модель с таким real-time factor"""
+        engine = 'stub'
+        package = 'stub'
+
+        def _load(self):
+            return object()
+
+        def transcribe(self, audio) -> str:
+            time.sleep(len(audio) / SAMPLE_RATE * rtf)
+            return 'тестовая расшифровка голосового сообщения'
+
+    media_saver.engine = StubEngine(preload='lazy')
+    # ffmpeg не нужен: любая запись декодируется в VOICE_SECONDS тишины
+    media_worker.load_audio = lambda source, sr=SAMPLE_RATE, spill_dir=None: np.zeros(VOICE_SECONDS * sr, np.float32)
+
+
+# --- Синтетические апдейты ---
+
+class UpdateFactory:
+
+    def __init__(self, chats: int, users: int = 50):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.chat_ids = [-1002000000000 - i for i in range(chats)]
+        self.users = [
+            {'id': 5000 + i, 'is_bot': False, 'first_name': f'Bench{i}', 'username': f'bench{i}',
+             'language_code': 'ru'}
+            for i in range(users)
+        ]
+        self.recent = {}
+        # chat_id -> id открытых задач, для кнопок смены статуса
+        self.tasks = {}
+
+    def _message(self, chat_id, user=None, **content):
+        message = dict({
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Bench {chat_id}'},
+            'from': user or random.choice(self.users),
+        }, **content)
+        self.recent[chat_id] = message
+        return message
+
+    def _file(self, prefix: str) -> dict:
+        file_id = f'{prefix}{next(self.file_ids):010d}'
+        return {'file_id': file_id, 'file_unique_id': file_id[-12:]}
+
+    def make(self, kind: str) -> dict:
+        chat_id = random.choice(self.chat_ids)
+        update = {'update_id': next(self.update_ids)}
+
+        if kind == 'text':
+            update['message'] = self._message(chat_id, text=f'обычное сообщение {update["update_id"]} про отчет и сроки')
+        elif kind == 'reply':
+            previous = self.recent.get(chat_id) or self._message(chat_id, text='исходное сообщение')
+            update['message'] = self._message(chat_id, text='ответ на сообщение', reply_to_message=previous)
+        elif kind == 'forward':
+            update['message'] = self._message(chat_id, text='пересланное сообщение',
+                                              forward_from=random.choice(self.users),
+                                              forward_date=int(time.time()) - 3600)
+        elif kind == 'task':
+            executor = random.choice(self.users)['username']
+            text = f'@{BOT_USERNAME} подготовить отчет к пятнице @{executor}'
+            update['message'] = self._message(chat_id, text=text, entities=[
+                {'type': 'mention', 'offset': 0, 'length': len(BOT_USERNAME) + 1},
+                {'type': 'mention', 'offset': text.rindex('@'), 'length': len(executor) + 1},
+            ])
+        elif kind == 'tasks':
+            update['message'] = self._message(chat_id, text='/tasks', entities=[
+                {'type': 'bot_command', 'offset': 0, 'length': 6},
+            ])
+        elif kind == 'callback':
+            tasks = self.tasks.get(chat_id)
+            if tasks:
+                task_id = random.choice(tasks)
+                data = random.choice([
+                    'tasks_after_0', 'pick_after_0', f'selected_task_{task_id}_0',
+                    f'status_{random.choice("🔄✅❌")}_{task_id}_0',
+                ])
+            else:
+                data = 'tasks_after_0'
+            message = self._message(chat_id, user={'id': BOT_ID, 'is_bot': True, 'first_name': 'Fake',
+                                                   'username': BOT_USERNAME}, text='список задач')
+            update['callback_query'] = {
+                'id': str(update['update_id']), 'from': random.choice(self.users),
+                'chat_instance': str(chat_id), 'message': message, 'data': data,
+            }
+        elif kind == 'photo':
+            photo = self._file('photo')
+            update['message'] = self._message(chat_id, caption='фото', photo=[
+                dict(photo, width=320, height=240, file_size=20000),
+                dict(photo, file_id=photo['file_id'] + 'x', width=1280, height=960, file_size=180000),
+            ])
+        elif kind == 'voice':
+            update['message'] = self._message(chat_id, voice=dict(
+                self._file('voice'), duration=VOICE_SECONDS, mime_type='audio/ogg', file_size=40000))
+        else:
+            raise ValueError(kind)
+        return update
+
+    def make_mixed(self) -> dict:
+        kinds, weights = zip(*MIXED_WEIGHTS.items())
+        return self.make(random.choices(kinds, weights)[0])
+
+
+# --- Прогон ---
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def drain(baseline: set, timeout: float = 120) -> int:
+    """Ждет фоновые задачи сценария (скачивание, транскрипцию) и дописывает буферы.
+
+    Возвращает число задач, не завершившихся за timeout.
+    """
+    from services.worker import message_buffer
+    from services.identity import identity_cache
+    from bot import message_saver
+
+    deadline = time.monotonic() + timeout
+    while True:
+        pending = [task for task in asyncio.all_tasks() - baseline
+                   if task is not asyncio.current_task() and not task.done()]
+        if not pending or time.monotonic() >= deadline:
+            break
+        await asyncio.wait(pending, timeout=0.1)
+    await message_buffer.flush()
+    await message_saver.media_saver.transcripts.flush()
+    # close() только дописывает буфер last_seen, писать в него можно и дальше
+    await identity_cache.close()
+    return len(pending)
+
+
+async def run_scenario(app, factory: UpdateFactory, name: str, updates: int, rate: float) -> dict:
+    from database import db
+
+    # Снимок на каждый сценарий: drain ждет только то, что запущено в нем
+    baseline = set(asyncio.all_tasks())
+
+    if name == 'callback':
+        for chat_id in factory.chat_ids:
+            rows, _, _ = await db.show_tasks_page(limit=200, chat_id=chat_id, thread_id=0)
+            factory.tasks[chat_id] = [row[0] for row in rows]
+
+    errors = Counter()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    app.add_error_handler(on_error)
+    before = Counter(STATEMENTS)
+    latencies = []
+
+    async def process(update):
+        started = time.perf_counter()
+        # Тот же путь, что у Application при concurrent_updates
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+    from telegram import Update
+    started = time.perf_counter()
+    tasks = []
+    for i in range(updates):
+        data = factory.make_mixed() if name == 'mixed' else factory.make(name)
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(Update.de_json(data, app.bot))))
+    await asyncio.gather(*tasks)
+    handled = time.perf_counter() - started
+    unfinished = await drain(baseline)
+    elapsed = time.perf_counter() - started
+    if unfinished:
+        print(f'⚠️ {name}: {unfinished} фоновых задач не завершились, время сценария неверно', file=sys.stderr)
+    app.remove_error_handler(on_error)
+
+    latencies.sort()
+    statements = Counter(STATEMENTS)
+    statements.subtract(before)
+    statements = +statements
+    return {
+        'scenario': name,
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / handled, 1) if handled else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'errors': dict(errors),
+        'unfinished': unfinished,
+        'statements': sum(statements.values()),
+        'statements_per_update': round(sum(statements.values()) / updates, 2),
+        'statement_kinds': dict(statements.most_common()),
+    }
+
+
+def print_report(results, verbose: bool) -> None:
+    header = f'{"scenario":<10}{"updates":>8}{"sec":>8}{"upd/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}' \
+             f'{"errors":>8}{"unfin":>7}{"stmts":>8}{"stmt/upd":>10}'
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f'{r["scenario"]:<10}{r["updates"]:>8}{r["seconds"]:>8.2f}{r["updates_per_second"]:>9.1f}'
+              f'{r["p50_ms"]:>9.2f}{r["p95_ms"]:>9.2f}{r["p99_ms"]:>9.2f}'
+              f'{sum(r["errors"].values()):>8}{r["unfinished"]:>7}{r["statements"]:>8}{r["statements_per_update"]:>10.2f}')
+        if verbose:
+            for kind, count in r['statement_kinds'].items():
+                print(f'{"":<12}{count:>8}  {kind}')
+
+
+async def main_async(args) -> list:
+    import database
+    from bot import build_application, message_saver
+    from services.scheduler import transcription_scheduler
+
+    # Логи на каждое сообщение искажают замер
+    logging.getLogger().setLevel(logging.WARNING)
+    install_statement_counter(database)
+    install_stub_engine(message_saver.media_saver, args.stub_rtf)
+
+    app = build_application(request=make_stub_request())
+    await app.initialize()
+    await app.start()
+    # Исполнители планировщика живут до конца процесса: запускаем до снимков задач в run_scenario
+    transcription_scheduler.start()
+
+    factory = UpdateFactory(args.chats)
+    # Прогрев: пул соединений, кэши
+    await run_scenario(app, factory, 'mixed', min(50, args.updates), 0)
+
+    results = []
+    for name in args.scenarios:
+        result = await run_scenario(app, factory, name, args.updates, args.rate)
+        results.append(result)
+        if args.verbose:
+            print(f'{name}: {result["updates_per_second"]} upd/s, p99 {result["p99_ms"]} ms', file=sys.stderr)
+
+    await app.stop()
+    await app.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон хендлеров бота на синтетических апдейтах')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'через запятую из: {", ".join(SCENARIOS)}')
+    parser.add_argument('--updates', type=int, default=300, help='апдейтов на сценарий')
+    parser.add_argument('--rate', type=float, default=100, help='апдейтов в секунду, 0 - без паузы')
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--stub-rtf', type=float, default=0.05, help='real-time factor заглушки модели')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fresh', action='store_true', help='удалить схему bot_data перед прогоном')
+    parser.add_argument('--json', help='записать результаты в файл для сравнения прогонов')
+    parser.add_argument('-v', '--verbose', action='store_true', help='SQL-выражения по видам')
+    args = parser.parse_args()
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(sorted(unknown))}')
+    random.seed(args.seed)
+
+    configure_env()
+    if args.fresh:
+        drop_schema()
+
+    results = asyncio.run(main_async(args))
+    print_report(results, args.verbose)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
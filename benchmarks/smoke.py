@@ -0,0 +1,80 @@
+"""Быстрая проверка горячих запросов на живой базе с PG_PREPARED_STATEMENTS=1.
+
+PREPARE каждого PreparedStatement (ошибки вывода типов параметров видны только
+на сервере), затем add_task и цепочка change_status со сверкой агрегатов /stats.
+Нужна одноразовая база, как для benchmarks/replay.py:
+
+    PG_HOST=127.0.0.1 PG_PORT=5434 PG_DBNAME=bench PG_USER=postgres PG_PASSWORD=bench \\
+        python -m benchmarks.smoke
+"""
+import asyncio
+import os
+import sys
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        sys.exit(f'❌ {message}')
+    print(f'✅ {message}')
+
+
+async def main_async() -> None:
+    import database
+    from database import db, PreparedStatement
+
+    def _prepare_all(cur):
+        # save_message появляется после подготовки схемы - первым run()
+        statements = [value for value in vars(type(db)).values() if isinstance(value, PreparedStatement)]
+        statements.append(db.save_message_statement)
+        for statement in statements:
+            statement._prepared(cur)
+        cur.execute('SELECT name FROM pg_prepared_statements;')
+        return {statement.name for statement in statements}, {row[0] for row in cur.fetchall()}
+
+    names, prepared = await db.pg.run(_prepare_all)
+    check(names <= prepared, f'PREPARE: {", ".join(sorted(names))}')
+
+    chat_id = -1009000000000 - os.getpid()
+    await db.add_or_update_user(1, 'smoke_maker', 'Smoke', '', chat_id, 'Smoke', 'supergroup', False, None)
+    await db.add_task('smoke task', 'smoke_executor', 1, 'smoke_maker', chat_id=chat_id, thread_id=0)
+    rows, _, _ = await db.show_tasks_page(limit=1, chat_id=chat_id, thread_id=0)
+    task_id = rows[0][0]
+
+    for status in ('🔄', '✅', '🏁'):
+        changed = await db.change_status(task_id, status, 1, 'smoke_maker', chat_id=chat_id)
+        check(changed, f'change_status {task_id} -> {status}')
+    check(not await db.change_status(task_id, '🔄', 1, 'smoke_maker', chat_id=chat_id + 1),
+          'change_status из чужого чата не меняет задачу')
+
+    # Задача из версий до привязки к чатам: видна и меняется в любом чате
+    def _add_legacy_task(cur):
+        cur.execute("INSERT INTO bot_data.tasks (task, taskmaker_user_id, taskmaker_username, status, created_dt) "
+                    "VALUES ('legacy task', 1, 'smoke_maker', '🆕', NOW()) RETURNING id;")
+        return cur.fetchone()[0]
+
+    legacy_id = await db.pg.run(_add_legacy_task)
+    rows, _, _ = await db.show_tasks_page(limit=200, chat_id=chat_id, thread_id=0)
+    check(legacy_id in [row[0] for row in rows], 'задача без чата видна в /tasks чата')
+    check(await db.change_status(legacy_id, '🏁', 1, 'smoke_maker', chat_id=chat_id), 'задачу без чата можно закрыть')
+
+    stats = await db.task_stats(chat_id=chat_id, days=1)
+    check(len(stats) == 1, 'агрегаты: одна строка на исполнителя')
+    _, _, executor, open_tasks, created, done, _ = stats[0]
+    check((executor, open_tasks, created, done) == ('smoke_executor', 0, 1, 1),
+          f'агрегаты: открыто {open_tasks}, создано {created}, сделано {done}')
+
+    await db.rebuild_task_stats()
+    check(await db.task_stats(chat_id=chat_id, days=1) == stats, 'пересборка дает те же агрегаты')
+    database.db.close()
+
+
+def main():
+    os.environ['PG_PREPARED_STATEMENTS'] = '1'
+    dbname = os.getenv('PG_DBNAME', '')
+    if 'bench' not in dbname and 'test' not in dbname:
+        sys.exit(f'База {dbname!r} не похожа на одноразовую (нужно bench/test в имени)')
+    asyncio.run(main_async())
+
+
+if __name__ == '__main__':
+    main()
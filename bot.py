@@ -1,11 +1,25 @@
+import asyncio
 import os
 
-from telegram import Update, InlineKeyboardButton,InlineKeyboardMarkup
-from telegram.ext import Application, ContextTypes, MessageHandler, filters, CommandHandler, CallbackQueryHandler
+from telegram import Update
+from telegram.ext import (
+    Application, ApplicationHandlerStop, ContextTypes, MessageHandler, filters, CommandHandler,
+    CallbackQueryHandler, TypeHandler
+)
 
 from database import db
-from services.worker import MessageSaver
+from services.worker import MessageSaver, message_buffer, TRANSCRIPTION_MODE
+from services.identity import identity_cache
+from services.task_parser import parse_task_command
+from services.scheduler import transcription_scheduler
 from services.media_worker import MediaSaver
+from services.engines import transcription_engine
+from services.chunking import chunked_transcriber
+from services.task_views import task_views, task_scope, ALL_CHATS_SUFFIX
+from services.search import message_search, query_from_text
+from services.task_stats import chat_stats, parse_days
+from services.dispatcher import PerChatUpdateProcessor
+from services.metrics import registry, instrument_handler, start_metrics_server
 import logging
 import sys
 
@@ -18,11 +32,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+message_saver = MessageSaver(db)
+
+# polling - один процесс забирает getUpdates, webhook - Telegram шлет апдейты во встроенный HTTP-сервер,
+# реплик может быть сколько угодно за балансировщиком
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Публичный адрес webhook'а и секрет заголовка X-Telegram-Bot-Api-Secret-Token; в режиме webhook обязательны
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Другой адрес Bot API, например tools/fake_telegram.py для локальных прогонов
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL')
+
+# Кому доступен список задач по всем чатам: /tasks all
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
 
-def user_chat(update:Update):
+
+async def user_chat(update:Update):
     user = update.effective_user
     chat = update.effective_chat
-    db.add_or_update_user(
+    await identity_cache.touch(
         user_id=user.id,
         username=user.username or "",
         first_name=user.first_name or "",
@@ -36,103 +68,109 @@ def user_chat(update:Update):
     return user,chat
 
 
+async def skip_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Telegram повторяет доставку при таймауте, балансировщик - при сбое реплики:
+    # апдейт обрабатывает только та реплика, что первой записала его update_id
+    if not await db.claim_update(update.update_id):
+        logger.info(f'♻️ update {update.update_id} уже обработан, пропускаем')
+        raise ApplicationHandlerStop
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-    user, chat = user_chat(update)
+    user, chat = await user_chat(update)
 
-    bot_username = (await context.bot.get_me()).username
+    # username бота получен один раз в Application.initialize()
+    bot_username = context.bot.username
 
-    await update.message.reply_text(f"Мы уже знакомы {user.username}!\nДля того чтобы отправить задачу, напиши:\n\n@{bot_username} 'текст задачи' @исполнитель\n\nПосмотреть список задач можно по команде /tasks")
+    await update.message.reply_text(f"Мы уже знакомы {user.username}!\nДля того чтобы отправить задачу, напиши:\n\n@{bot_username} 'текст задачи' @исполнитель\n\nПосмотреть список задач можно по команде /tasks\nНайти сообщения в архиве чата - /search текст\nСтатистика по задачам - /stats")
 
 
 async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-    user, chat = user_chat(update)
+    user, chat = await user_chat(update)
     taskmaker_user_id= user.id
     taskmaker_username = user.username
 
-    message_text = update.message.text
+    bot_username = context.bot.username
 
-    bot_username = (await context.bot.get_me()).username
+    command = parse_task_command(update.message, bot_username)
 
-    if message_text.startswith(f'@{bot_username}'):
-        message = message_text.replace(f'@{bot_username}', "").strip()
+    if command is not None:
         # Проверка 1: пустое сообщение
-        if message_text == "":
+        if not command.task and not command.executors:
             await update.message.reply_text(
                 f"Чтобы добавить задачу используй структуру:\n\n@{bot_username} 'текст задачи' @исполнитель\n\nПосмотреть список задач можно по команде /tasks")
             return  # Выходим из функции
 
-        # Разделяем по @
-        parts = message.split('@', 1)  # Разделяем только по первому @
-
-        if len(parts) != 2:
-            await update.message.reply_text(f"Я не понимаю используй формат\n\n@{bot_username} 'текст задачи' @исполнитель")
+        # Проверка 2: нет исполнителя, слишком много исполнителей или пустая задача
+        if command.error:
+            await update.message.reply_text(command.error)
             return
 
-        # Проверка 2: нет исполнителя
-        if len(parts) == 1:
-            await update.message.reply_text("Надо добавить исполнителя")
-            return
+        # Добавляем в БД: по задаче на каждого исполнителя, в область чата/топика
+        chat_id, thread_id = task_scope(update.message)
+        for executor in command.executors:
+            await db.add_task(command.task, executor.username, taskmaker_user_id, taskmaker_username,
+                              executor_user_id=executor.user_id, chat_id=chat_id, thread_id=thread_id)
+        executors = ', '.join(executor.display for executor in command.executors)
+        await update.message.reply_text(f'🔰 {command.task}\nВыполняет: {executors}')
+        return
 
-        # Проверка 3: больше 2-х исполнителей
-        if len(parts) > 3:
-            await update.message.reply_text('У задачи не может быть больше двух исполнителей')
-            return
+    await message_saver.save_group_message(update,context)
 
-        # Проверка 4: правильный формат (1 задача и 1 исполнитель)
-        if len(parts) == 2:
-            task = parts[0].strip().lower()
-            after_at = parts[1].strip()
-            username_parts = after_at.split()
-            executor_username = username_parts[0] if username_parts else ""
 
-            if not task:
-                await update.message.reply_text("Задача не может быть пустой!")
-                return
+async def handle_media(update:Update,context:ContextTypes.DEFAULT_TYPE):
+    await message_saver.save_group_message(update, context)
 
-            if not executor_username:
-                await update.message.reply_text("Имя исполнителя не может быть пустым!")
+
+async def show_all_tasks(update:Update,context:ContextTypes.DEFAULT_TYPE):
+
+        user, chat = await user_chat(update)
+
+        scope = task_scope(update.message)
+        if context.args and context.args[0] == 'all':
+            if user.id not in ADMIN_USER_IDS:
+                await update.message.reply_text('Список по всем чатам доступен только администраторам')
                 return
+            scope = None
 
-            # Добавляем в БД
-            db.add_task(task, executor_username,taskmaker_user_id,taskmaker_username)
-            await update.message.reply_text(f'🔰 {task}\nВыполняет: @{executor_username}')
+        view = await task_views.view(scope, 'tasks')
+        if view is None:
+            await update.message.reply_text('Пока еще не было создано ни одной задачи')
             return
 
-        # Если что-то пошло не так
-        await update.message.reply_text(f"Неверный формат. Используйте:\n@{bot_username} задача @исполнитель")
-
-    await MessageSaver(db).save_group_message(update,context)
+        await update.message.reply_text(view.text, reply_markup=view.reply_markup)
 
 
-async def handle_media(update:Update,context:ContextTypes.DEFAULT_TYPE):
-    await MessageSaver(db).save_group_message(update, context)
 
 
-async def show_all_tasks(update:Update,context:ContextTypes.DEFAULT_TYPE):
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-        user, chat = user_chat(update)
+    user, chat = await user_chat(update)
 
-        task_list_tuples = db.show_all_tasks()
-        if not task_list_tuples:
-            await update.message.reply_text('Пока еще не было создано ни одной задачи')
+    # /stats [дней], /stats all [дней] - по всем чатам, только администраторам
+    chat_id = chat.id
+    if context.args and 'all' in context.args:
+        if user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text('Статистика по всем чатам доступна только администраторам')
             return
+        chat_id = None
 
-        task_list_tuples.sort(key=lambda x: x[0])
-        answer=''
-        for i in task_list_tuples:
-            answer+=f'{i[0]}. {i[1]}- {i[2]} ({i[3]})\n'
+    await update.message.reply_text(await chat_stats(chat_id, parse_days(context.args)))
 
-        keyboard = []
-        keyboard.append([
-            InlineKeyboardButton("Изменить статус задачи", callback_data="change_task")
-        ])
-        reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await update.message.reply_text(f'{answer}',reply_markup=reply_markup)
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
+    user, chat = await user_chat(update)
 
+    query = ' '.join(context.args)
+    if not query:
+        await update.message.reply_text('Напиши, что искать: /search текст\n\nМожно "точную фразу", -исключить слово, or')
+        return
+
+    view = await message_search.search(chat.id, query)
+    await update.message.reply_text(view.text, reply_markup=view.reply_markup)
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -144,99 +182,173 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await query.answer()
 
-    task_list_tuples = db.show_all_tasks()
-    if not task_list_tuples:
-        await update.message.reply_text('Пока еще не было создано ни одной задачи')
+    if callback_data.startswith("search_"):
+        _, token, page = callback_data.split("_")
+        view = message_search.page(token, int(page))
+        # Кэш истек или кнопку нажали на другой реплике: запрос есть в тексте сообщения
+        search_query = query_from_text(query.message.text) if view is None else None
+        if search_query:
+            await message_search.search(query.message.chat_id, search_query)
+            view = message_search.page(token, int(page))
+        if view is None:
+            await query.edit_message_text('Результаты поиска устарели, повтори /search')
+            return
+
+        await query.edit_message_text(text=view.text, reply_markup=view.reply_markup)
         return
-    task_list_tuples.sort(key=lambda x: x[0])
-    answer = ''
-    for i in task_list_tuples:
-        answer += f'{i[0]}. {i[1]}- {i[2]} ({i[3]})\n'
 
-    if callback_data == "change_task":
+    # Кнопки списка по всем чатам помечены суффиксом, права проверяем на каждое нажатие
+    scope = task_scope(query.message)
+    if callback_data.endswith(ALL_CHATS_SUFFIX):
+        if changer_user_id not in ADMIN_USER_IDS:
+            return
+        callback_data = callback_data[:-len(ALL_CHATS_SUFFIX)]
+        scope = None
 
-        tasks_numbers = [i[0] for i in task_list_tuples]
-        # Создаем сетку 4 колонки
-        columns = 4
-        keyboard = []
+    # Кнопки со старых сообщений: change_task, selected_task_N, status_X
+    if callback_data == "change_task":
+        callback_data = "pick_after_0"
 
-        for i in range(0, len(tasks_numbers), columns):
-            row_numbers = tasks_numbers[i:i + columns]
-            row_buttons = [
-                InlineKeyboardButton(str(num), callback_data=f"selected_task_{num}")
-                for num in row_numbers
-            ]
-            keyboard.append(row_buttons)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if callback_data.startswith(("tasks_", "pick_")):
+        kind, direction, anchor = callback_data.split("_")
+        view = await task_views.view(scope, kind, direction, int(anchor))
+        if view is None:
+            await query.edit_message_text('Пока еще не было создано ни одной задачи')
+            return
 
-        await query.edit_message_text(
-            text=f"{answer}\nВыбери номер задачи:",
-            reply_markup=reply_markup
-        )
+        await query.edit_message_text(text=view.text, reply_markup=view.reply_markup)
 
     if callback_data.startswith("selected_task_"):
-        task_id = int(callback_data.split("_")[2])
+        parts = callback_data.split("_")
+        task_id = int(parts[2])
+        page = int(parts[3]) if len(parts) > 3 else 0
         context.user_data['selected_task_id'] = task_id
 
-        keyboard = [
-            [
-                InlineKeyboardButton("🔄 Начали", callback_data="status_🔄"),
-                InlineKeyboardButton("❌ Отменена", callback_data="status_❌")
-
-            ],
-            [
-                InlineKeyboardButton("✅ Выполнена", callback_data="status_✅"),
-                InlineKeyboardButton("🔰 Новая", callback_data="status_🔰")
-            ],
-            [
-                InlineKeyboardButton("🏁 Завершена", callback_data="status_🏁")
-            ]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        view = await task_views.view(scope, 'status', 'after', page, task_id=task_id)
+        if view is None:
+            await query.edit_message_text('Пока еще не было создано ни одной задачи')
+            return
 
-        await query.edit_message_text(
-            text=f"{answer}\nКакой статус поставим?",
-            reply_markup=reply_markup
-        )
+        await query.edit_message_text(text=view.text, reply_markup=view.reply_markup)
 
     if callback_data.startswith("status_"):
-        status = callback_data.split("_")[1]
-        task_id = context.user_data.get('selected_task_id')
-        db.change_status(task_id=task_id, status=status,changer_user_id=changer_user_id,changer_username=changer_username)
+        parts = callback_data.split("_")
+        status = parts[1]
+        # Номер задачи теперь в самой кнопке, user_data - только для старых сообщений
+        task_id = int(parts[2]) if len(parts) > 2 else context.user_data.get('selected_task_id')
+        page = int(parts[3]) if len(parts) > 3 else 0
+        # Из чата можно менять только его задачи
+        changed = await db.change_status(task_id=task_id, status=status,changer_user_id=changer_user_id,changer_username=changer_username,
+                                         chat_id=scope[0] if scope is not None else None)
+        if not changed:
+            await query.edit_message_text(f"Задача # {task_id} не найдена")
+            return
 
-        keyboard = []
-        keyboard.append([
-            InlineKeyboardButton("Изменить статус задачи", callback_data="change_task")
-        ])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        view = await task_views.view(scope, 'tasks', 'after', page)
+        if view is None:
+            await query.edit_message_text(f"Задача # {task_id} получила статус {status}")
+            return
 
         await query.edit_message_text(
-            text=f"{answer}\nЗадача # {task_id} получила статус {status}",
-            reply_markup=reply_markup
+            text=f"{view.text}\nЗадача # {task_id} получила статус {status}",
+            reply_markup=view.reply_markup
         )
 
 
 
 
-def main():
-
-    app = Application.builder().token(os.getenv('TOKEN')).build()
-    app.add_handler(CommandHandler('start',start_command))
-    app.add_handler(CommandHandler('tasks',show_all_tasks))
+async def post_init(app: Application):
+    # Сброс кэша списков задач по NOTIFY от других инстансов бота
+    app.bot_data['tasks_listener'] = asyncio.get_running_loop().create_task(
+        db.pg.listen(db.TASKS_CHANNEL, task_views.invalidate)
+    )
+    # Секции group_messages на месяцы вперед, удаление старых, чистка processed_updates
+    app.bot_data['maintenance'] = asyncio.get_running_loop().create_task(db.maintenance_forever())
+    app.bot_data['metrics_server'] = await start_metrics_server()
+    # В режиме queue бот модель не грузит вовсе: транскрибируют отдельные воркеры
+    if TRANSCRIPTION_MODE == 'inline' and transcription_engine.preload == 'background':
+        app.create_task(transcription_engine.warm_up())
+
+
+async def post_shutdown(app: Application):
+    app.bot_data['tasks_listener'].cancel()
+    app.bot_data['maintenance'].cancel()
+    if app.bot_data['metrics_server'] is not None:
+        app.bot_data['metrics_server'].close()
+    await message_buffer.close()
+    await message_saver.media_saver.close()
+    await identity_cache.close()
+    transcription_scheduler.close()
+    chunked_transcriber.close()
+    db.close()
+
+
+def build_application(request=None) -> Application:
+    """Application со всеми хендлерами. request - подмена HTTP-клиента Bot API (бенчмарки)"""
+
+    # Чаты обрабатываются параллельно, апдейты одного чата - по порядку
+    update_processor = PerChatUpdateProcessor()
+    registry.gauge('bot_updates_waiting', 'Апдейты в очередях чатов и в ожидании слота',
+                   fn=lambda: update_processor.waiting)
+    registry.gauge('bot_updates_running', 'Апдейты, обрабатываемые сейчас',
+                   fn=lambda: update_processor.running)
+
+    builder = (
+        Application.builder()
+        .token(os.getenv('TOKEN'))
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f'{TELEGRAM_BASE_URL}/bot').base_file_url(f'{TELEGRAM_BASE_URL}/file/bot')
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+
+    if BOT_MODE == 'webhook':
+        app.add_handler(TypeHandler(Update, instrument_handler(skip_duplicate_update)), group=-1)
+    app.add_handler(CommandHandler('start',instrument_handler(start_command)))
+    app.add_handler(CommandHandler('tasks',instrument_handler(show_all_tasks)))
+    app.add_handler(CommandHandler('search',instrument_handler(search_command)))
+    app.add_handler(CommandHandler('stats',instrument_handler(stats_command)))
     app.add_handler(MessageHandler(
-        filters.TEXT & (~filters.COMMAND), handle_messages,
+        filters.TEXT & (~filters.COMMAND), instrument_handler(handle_messages),
     ))
     app.add_handler(MessageHandler(
-        filters.ALL & (~filters.COMMAND), handle_media,
+        filters.ALL & (~filters.COMMAND), instrument_handler(handle_media),
     ))
 
 
-    app.add_handler(CallbackQueryHandler(button_callback))
+    app.add_handler(CallbackQueryHandler(instrument_handler(button_callback)))
+    return app
+
+
+def main():
+
+    if BOT_MODE == 'webhook':
+        # Без адреса PTB зарегистрирует в Telegram http://0.0.0.0:..., без секрета примет апдейт от кого угодно
+        missing = [name for name, value in (('WEBHOOK_URL', WEBHOOK_URL), ('WEBHOOK_SECRET', WEBHOOK_SECRET)) if not value]
+        if missing:
+            logger.error(f'❌ BOT_MODE=webhook: не заданы {", ".join(missing)}')
+            sys.exit(1)
+
+    app = build_application()
 
     print('BOT ALIVE')
 
-    app.run_polling()
+    if BOT_MODE == 'webhook':
+        # Запросы без X-Telegram-Bot-Api-Secret-Token == WEBHOOK_SECRET отклоняются с 403
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling()
 
 
 if __name__=='__main__':
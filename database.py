@@ -1,25 +1,180 @@
-
 from datetime import datetime
 
+import asyncio
+import functools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Generator
+from typing import Generator, NamedTuple, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import psycopg2
-from psycopg2.extensions import connection as Connection
+from psycopg2.extensions import connection as Connection, ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 import os
+import logging
+
+from services.metrics import instrument_methods, DB_WAIT
+
+logger = logging.getLogger(__name__)
+
+# Горячие запросы готовятся (PREPARE) один раз на соединение.
+# 0 - за pgbouncer в режиме transaction, где сессия не закреплена за соединением
+PG_PREPARED_STATEMENTS = os.getenv('PG_PREPARED_STATEMENTS', '1') == '1'
+
+
+class PooledConnection(Connection):
+    """Соединение из пула: помнит, когда его последний раз проверяли, и что на нем уже подготовлено"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked_at = time.monotonic()
+        self.prepared = set()
+        # PREPARE в текущей транзакции: при откате набор prepared сбрасывается
+        self.prepared_in_transaction = False
+
+    def forget_prepared(self) -> None:
+        with self.cursor() as cur:
+            cur.execute('DEALLOCATE ALL')
+        self.commit()
+        self.prepared.clear()
+
+
+class PreparedStatement:
+    """Серверный prepared statement: PREPARE на первом вызове в соединении, дальше только EXECUTE.
+
+    sql - с параметрами $1..$n; повторяющийся параметр везде с одним приведением ($1::varchar).
+    Без PG_PREPARED_STATEMENTS (или вне пула) тот же текст выполняется обычным
+    запросом: $k заменяются на %s, параметры раскладываются по местам.
+    """
+
+    def __init__(self, name: str, sql: str, enabled: bool = PG_PREPARED_STATEMENTS):
+        params = [(int(number), cast) for number, cast in re.findall(r'\$(\d+)(::\w+)?', sql)]
+        self.order = [number for number, _ in params]
+        count = max(self.order, default=0)
+        if set(self.order) != set(range(1, count + 1)):
+            raise ValueError(f'{name}: параметры должны быть $1..$n без пропусков')
+        for number in set(self.order):
+            casts = {cast for param, cast in params if param == number}
+            if self.order.count(number) > 1 and (len(casts) != 1 or '' in casts):
+                raise ValueError(f'{name}: повторяющийся ${number} должен везде иметь одно приведение типа')
+        self.name = name
+        self.sql = sql
+        self.enabled = enabled
+        self.execute_sql = f'EXECUTE {name} ({", ".join(["%s"] * count)})'
+        self.plain_sql = re.sub(r'\$\d+', '%s', sql)
+        self._in_order = self.order == list(range(1, count + 1))
+
+    def _prepared(self, cur) -> bool:
+        conn = cur.connection
+        if not self.enabled or not isinstance(conn, PooledConnection):
+            return False
+        if self.name not in conn.prepared:
+            conn.prepared_in_transaction = True
+            cur.execute(f'PREPARE {self.name} AS {self.sql}')
+            conn.prepared.add(self.name)
+        return True
+
+    def _plain_params(self, params) -> tuple:
+        return tuple(params) if self._in_order else tuple(params[number - 1] for number in self.order)
+
+    def statement(self, cur, params) -> tuple:
+        """(текст, параметры) для cur.execute: EXECUTE (с PREPARE, если на этом соединении еще не готовили)"""
+        if self._prepared(cur):
+            return self.execute_sql, tuple(params)
+        return self.plain_sql, self._plain_params(params)
+
+    def execute(self, cur, params) -> None:
+        cur.execute(*self.statement(cur, params))
+
+    def execute_many(self, cur, rows) -> None:
+        """Все строки одним обращением к серверу: EXECUTE ...; EXECUTE ...; через execute_batch"""
+        if self._prepared(cur):
+            execute_batch(cur, self.execute_sql, rows, page_size=len(rows))
+        else:
+            execute_batch(cur, self.plain_sql, [self._plain_params(row) for row in rows], page_size=len(rows))
+
+
+def _execute_statements(cur, statements) -> None:
+    """[(PreparedStatement, params)] одним обращением к серверу"""
+    texts, params = [], []
+    for statement, statement_params in statements:
+        text, bound = statement.statement(cur, statement_params)
+        texts.append(text)
+        params.extend(bound)
+    cur.execute('; '.join(texts), params)
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool, который не теряет соединения и не падает при нехватке.
+
+    Базовый пул закрывает всё, что возвращают сверх minconn, - под нагрузкой это
+    новое подключение почти на каждый запрос и потерянные PREPARE. Здесь
+    простаивающих держим до maxconn (открываются лениво, minconn - сразу), а
+    getconn при исчерпании ждет возврата соединения вместо PoolError.
+    """
+
+    def __init__(self, minconn, maxconn, *args, timeout: float = None, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f'нет свободного соединения с Postgres за {self.timeout} с')
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._slots.release()
+
+    def _putconn(self, conn, key=None, close=False):
+        # Вызывается под замком пула: на время возврата порог простаивающих - maxconn
+        minconn, self.minconn = self.minconn, self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
 
 
 class PgConnect:
-    def __init__(self) -> None:
+    def __init__(self,
+                 min_size: int = int(os.getenv('PG_POOL_MIN', '2')),
+                 max_size: int = int(os.getenv('PG_POOL_MAX', '10')),
+                 pool_timeout: float = float(os.getenv('PG_POOL_TIMEOUT', '30')),
+                 statement_timeout_ms: int = int(os.getenv('PG_STATEMENT_TIMEOUT_MS', '5000')),
+                 health_check_interval: float = float(os.getenv('PG_HEALTH_CHECK_INTERVAL', '30'))) -> None:
         self.host = str(os.getenv('PG_HOST'))
         self.port = int(str(os.getenv('PG_PORT')))
         self.db_name = str(os.getenv('PG_DBNAME'))
         self.user = str(os.getenv('PG_USER'))
         self.pw = str(os.getenv('PG_PASSWORD'))
 
+        # min_size соединений открываются сразу, остальные до max_size - по мере нужды и потом не закрываются
+        self.min_size = min_size
+        self.max_size = max_size
+        # Сколько ждать свободное соединение, когда заняты все max_size
+        self.pool_timeout = pool_timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._setup = None
+        self._setup_done = False
+        self._setup_lock = threading.Lock()
+        # Не больше потоков, чем соединений в пуле: лишние запросы ждут в очереди executor'а
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix='pg')
+
     def url(self) -> str:
         return """
             host={host}
@@ -28,31 +183,272 @@ class PgConnect:
             user={user}
             password={pw}
             target_session_attrs=read-write
+            options='-c statement_timeout={timeout}'
         """.format(
             host=self.host,
             port=self.port,
             db_name=self.db_name,
             user=self.user,
-            pw=self.pw)
+            pw=self.pw,
+            timeout=self.statement_timeout_ms)
+
+    def pool(self) -> BlockingConnectionPool:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = BlockingConnectionPool(
+                        self.min_size, self.max_size, self.url(),
+                        timeout=self.pool_timeout,
+                        connection_factory=PooledConnection
+                    )
+        return self._pool
+
+    def _is_alive(self, conn: PooledConnection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.checked_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        conn.checked_at = time.monotonic()
+        return True
+
+    def _checkout(self) -> PooledConnection:
+        pool = self.pool()
+        conn = pool.getconn()
+        if not self._is_alive(conn):
+            logger.info('♻️ Соединение с Postgres потеряно, переподключаемся')
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
 
     @contextmanager
-    def connection(self) -> Generator[Connection, None, None]:
-        conn = psycopg2.connect(self.url())
+    def connection(self, timeout_ms: int = None) -> Generator[Connection, None, None]:
+        conn = self._checkout()
+        conn.prepared_in_transaction = False
         try:
+            if timeout_ms is not None:
+                with conn.cursor() as cur:
+                    cur.execute('SET LOCAL statement_timeout = %s', (int(timeout_ms),))
             yield conn
             conn.commit()
         except Exception as e:
-            conn.rollback()
+            if not conn.closed:
+                conn.rollback()
+                if conn.prepared_in_transaction:
+                    # Что из подготовленного в откаченной транзакции дожило - неизвестно, готовим заново
+                    try:
+                        conn.forget_prepared()
+                    except psycopg2.Error:
+                        conn.close()
             raise e
         finally:
-            conn.close()
+            self.pool().putconn(conn, close=bool(conn.closed))
+
+    def on_setup(self, fn) -> None:
+        """fn(cursor) выполнится в своей транзакции один раз, перед первым запросом через run()"""
+        self._setup = fn
+        self._setup_done = False
+
+    def _ensure_setup(self) -> None:
+        if self._setup_done or self._setup is None:
+            return
+        with self._setup_lock:
+            if self._setup_done:
+                return
+            # Упала - повторим на следующем запросе
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    self._setup(cur)
+            self._setup_done = True
+
+    def _run_sync(self, fn, args, timeout_ms, submitted):
+        DB_WAIT.observe(time.perf_counter() - submitted)
+        self._ensure_setup()
+        with self.connection(timeout_ms) as conn:
+            with conn.cursor() as cur:
+                return fn(cur, *args)
+
+    async def run(self, fn, *args, timeout_ms: int = None):
+        """Выполняет fn(cursor, *args) в одной транзакции на соединении из пула, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(self._run_sync, fn, args, timeout_ms, time.perf_counter())
+        )
+
+    def _listen_connect(self, channel: str) -> Connection:
+        conn = psycopg2.connect(self.url())
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN {channel};')
+        return conn
+
+    async def listen(self, channel: str, callback, reconnect_delay: float = 5) -> None:
+        """Держит отдельное соединение с LISTEN channel и вызывает callback(payload) на каждое уведомление.
+
+        После (пере)подключения вызывает callback(None): уведомления за время
+        разрыва потеряны.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = None
+            try:
+                conn = await loop.run_in_executor(None, self._listen_connect, channel)
+                fd = conn.fileno()
+                lost = loop.create_future()
+
+                def _on_ready():
+                    try:
+                        conn.poll()
+                    except psycopg2.Error as e:
+                        if not lost.done():
+                            lost.set_exception(e)
+                        return
+                    while conn.notifies:
+                        callback(conn.notifies.pop(0).payload)
+
+                callback(None)
+                loop.add_reader(fd, _on_ready)
+                logger.info(f'👂 LISTEN {channel}')
+                try:
+                    await lost
+                finally:
+                    loop.remove_reader(fd)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.info(f'LISTEN {channel}: соединение потеряно: {e}')
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+            await asyncio.sleep(reconnect_delay)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        if self._pool is not None and not self._pool.closed:
+            self._pool.closeall()
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+MESSAGE_PARTITION_PREFIX = 'group_messages_p'
+
+
+def message_partition_name(month: datetime) -> str:
+    """Секция group_messages за месяц: group_messages_p2025_01"""
+    return f'{MESSAGE_PARTITION_PREFIX}{month:%Y_%m}'
+
+
+# Выполнена и принята - задача сделана (время цикла 🔰 → ✅/🏁), отменена - закрыта без выполнения
+TASK_DONE_STATUSES = ('✅', '🏁')
+TASK_CANCELLED_STATUSES = ('❌',)
+
+
+def _sql_list(values) -> str:
+    return '(' + ', '.join(f"'{value}'" for value in values) + ')'
+
+
+def task_scope_key(chat_id, thread_id) -> str:
+    """Ключ области задач для NOTIFY и кэшей: 'chat_id:thread_id'"""
+    return f'{chat_id}:{thread_id or 0}'
+
+
+def _execute(cur, sql, params=None):
+    cur.execute(sql, params)
 
 
+def _fetchall(cur, sql, params=None):
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+class MessageRow(NamedTuple):
+    """Строка bot_data.group_messages: поля в порядке колонок INSERT, без словаря на каждое сообщение"""
+    telegram_message_id: int
+    telegram_chat_id: int
+    telegram_thread_id: int
+    sender_user_id: int
+    sender_username: Optional[str]
+    sender_first_name: Optional[str]
+    sender_last_name: str
+    sender_is_bot: bool
+    sender_language_code: str
+    chat_type: str
+    chat_title: str
+    chat_is_forum: bool
+    message_type: str
+    message_text: str
+    has_media: bool
+    media_type: Optional[str]
+    media_file_id: Optional[str]
+    media_file_unique_id: Optional[str]
+    media_file_name: Optional[str]
+    media_mime_type: Optional[str]
+    media_file_size: Optional[int]
+    media_duration: Optional[int]
+    media_width: Optional[int]
+    media_height: Optional[int]
+    is_topic_message: bool
+    is_reply: bool
+    is_forwarded: bool
+    reply_to_message_id: Optional[int]
+    reply_to_user_id: Optional[int]
+    forum_topic_name: Optional[str]
+    forum_topic_icon_color: Optional[int]
+    forward_from_user_id: Optional[int]
+    forward_from_user_name: Optional[str]
+    forward_date: Optional[datetime]
+    telegram_date: datetime
+    transcript_status: Optional[str]
+
+
+@instrument_methods(exclude=('maintenance_forever',))
 class DataBase:
 
-    def __init__(self, pg: PgConnect):
+    # Канал NOTIFY об изменении задач: для сброса кэшей на всех инстансах бота
+    TASKS_CHANNEL = 'tasks_changed'
+
+    # Блокировка обслуживания секций: несколько инстансов не делают его одновременно
+    PARTITIONS_LOCK_ID = 0x6d736773
+    # Блокировка вытеснения медиа: хранилище общее у всех инстансов
+    MEDIA_EVICTION_LOCK_ID = 0x6d656469
 
+    def __init__(self, pg: PgConnect,
+                 partitions_ahead: int = int(os.getenv('MESSAGES_PARTITIONS_AHEAD', '3')),
+                 retention_months: int = int(os.getenv('MESSAGES_RETENTION_MONTHS', '0')),
+                 retention_mode: str = os.getenv('MESSAGES_RETENTION_MODE', 'detach'),
+                 migrate_messages: bool = os.getenv('MESSAGES_PARTITION_MIGRATE', '0') == '1'):
+
+        if retention_mode not in ('detach', 'drop'):
+            raise ValueError(f'Неизвестный режим хранения сообщений: {retention_mode}')
         self.pg = pg
+        self._task_listeners = []
+        # Секции на столько месяцев вперед; retention_months=0 - хранить всю историю,
+        # detach - старые секции уезжают в схему bot_archive, drop - удаляются
+        self.partitions_ahead = partitions_ahead
+        self.retention_months = retention_months
+        self.retention_mode = retention_mode
+        self.migrate_messages = migrate_messages
+        # Известны после _setup_schema
+        self.messages_partitioned = None
+        self.save_message_statement = None
+        # Схему готовит первый запрос, а не импорт: дочерние процессы и утилиты не ходят в БД зря
+        pg.on_setup(self._setup_schema)
+
+    def _setup_schema(self, cur) -> None:
+        """Схема, секции и агрегаты: один раз перед первым запросом процесса (PgConnect.on_setup)"""
 
         create_schema = """
                          CREATE SCHEMA IF NOT EXISTS bot_data;
@@ -95,10 +491,50 @@ class DataBase:
                             update_dt timestamp
                             );
 
+                            -- Частичный индекс только по незавершенным задачам: для постраничного /tasks
+                        CREATE INDEX IF NOT EXISTS idx_tasks_open
+                        ON bot_data.tasks (id) WHERE status != '🏁';
+
+                            -- Задача привязана к чату и топику форума, где ее создали
+                        ALTER TABLE bot_data.tasks ADD COLUMN IF NOT EXISTS chat_id BIGINT;
+                        ALTER TABLE bot_data.tasks ADD COLUMN IF NOT EXISTS thread_id INTEGER;
+
+                        CREATE INDEX IF NOT EXISTS idx_tasks_open_chat
+                        ON bot_data.tasks (chat_id, thread_id, id) WHERE status != '🏁';
+
+                            -- Когда задача стала сделанной; возврат в работу сбрасывает
+                        ALTER TABLE bot_data.tasks ADD COLUMN IF NOT EXISTS done_dt TIMESTAMP;
+
+                            -- История статусов задачи
+                        CREATE INDEX IF NOT EXISTS idx_transactions_task
+                        ON bot_data.transactions (task_id, update_dt);
+
+                            -- Агрегаты для /stats, обновляются в транзакции add_task/change_status.
+                            -- Задач в каждом статусе сейчас, по чату и исполнителю (chat_id 0 - задачи без чата)
+                        CREATE TABLE IF NOT EXISTS bot_data.task_status_counts (
+                            chat_id BIGINT NOT NULL,
+                            executor_username VARCHAR NOT NULL,
+                            status VARCHAR NOT NULL,
+                            tasks INTEGER NOT NULL DEFAULT 0,
+                            PRIMARY KEY (chat_id, executor_username, status)
+                            );
+
+                            -- Поток по дням: создано, сделано и суммарное время цикла сделанных в этот день
+                        CREATE TABLE IF NOT EXISTS bot_data.task_daily_stats (
+                            chat_id BIGINT NOT NULL,
+                            executor_username VARCHAR NOT NULL,
+                            day DATE NOT NULL,
+                            created INTEGER NOT NULL DEFAULT 0,
+                            done INTEGER NOT NULL DEFAULT 0,
+                            cycle_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                            PRIMARY KEY (chat_id, executor_username, day)
+                            );
+
 
-                            -- Таблица для хранения всех сообщений из групп
+                            -- Таблица для хранения всех сообщений из групп, секции по месяцам telegram_date.
+                            -- Ключи секционированной таблицы обязаны включать ключ секционирования
                         CREATE TABLE IF NOT EXISTS bot_data.group_messages (
-                            id SERIAL PRIMARY KEY,
+                            id SERIAL,
                             telegram_message_id BIGINT NOT NULL,
                             telegram_chat_id BIGINT NOT NULL,
                             telegram_thread_id INTEGER,  -- ID топика (для форумов)
@@ -156,79 +592,624 @@ class DataBase:
                             telegram_date TIMESTAMP NOT NULL,
                             created_at TIMESTAMP DEFAULT NOW(),
                             updated_at TIMESTAMP DEFAULT NOW(),
-                            CONSTRAINT unique_message_chat UNIQUE (telegram_message_id, telegram_chat_id)
-                            );
+                            PRIMARY KEY (id, telegram_date),
+                            CONSTRAINT unique_message_chat UNIQUE (telegram_message_id, telegram_chat_id, telegram_date)
+                            ) PARTITION BY RANGE (telegram_date);
                         
                         CREATE INDEX IF NOT EXISTS idx_group_messages_text 
                         ON bot_data.group_messages USING GIN (to_tsvector('russian', message_text)
                         );
+
+                            -- Каким движком и моделью получен транскрипт
+                        ALTER TABLE bot_data.group_messages ADD COLUMN IF NOT EXISTS transcript_engine VARCHAR(50);
+                        ALTER TABLE bot_data.group_messages ADD COLUMN IF NOT EXISTS transcript_model VARCHAR(100);
+                            -- pending - ждет транскрипции, done - текст записан, failed - попытки исчерпаны
+                        ALTER TABLE bot_data.group_messages ADD COLUMN IF NOT EXISTS transcript_status VARCHAR(20);
+
+                            -- Очередь транскрипций: бот ставит задания, воркеры забирают через SKIP LOCKED
+                        CREATE TABLE IF NOT EXISTS bot_data.transcription_jobs (
+                            id BIGSERIAL PRIMARY KEY,
+                            telegram_message_id BIGINT NOT NULL,
+                            telegram_chat_id BIGINT NOT NULL,
+                            media_type VARCHAR(50) NOT NULL,
+                            media_file_id VARCHAR(255) NOT NULL,
+                            media_file_unique_id VARCHAR(255),
+                            media_file_name VARCHAR(255),
+                            media_duration INTEGER,
+
+                            status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending / running / done / dead
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            max_attempts INTEGER NOT NULL DEFAULT 5,
+                            available_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            locked_until TIMESTAMP,
+                            locked_by VARCHAR(255),
+                            last_error TEXT,
+
+                            created_at TIMESTAMP DEFAULT NOW(),
+                            updated_at TIMESTAMP DEFAULT NOW(),
+                            CONSTRAINT unique_transcription_job UNIQUE (telegram_message_id, telegram_chat_id)
+                            );
+
+                        CREATE INDEX IF NOT EXISTS idx_transcription_jobs_ready
+                        ON bot_data.transcription_jobs (available_at, id) WHERE status IN ('pending', 'running');
+
+                            -- Кэш транскриптов: один и тот же файл, пересланный в разные чаты, распознаем один раз
+                        CREATE TABLE IF NOT EXISTS bot_data.transcripts (
+                            media_file_unique_id VARCHAR(255) NOT NULL,
+                            model VARCHAR(100) NOT NULL,
+                            transcript TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT NOW(),
+                            PRIMARY KEY (media_file_unique_id, model)
+                            );
+
+                            -- Хранилище медиа: файл лежит один раз по media_file_unique_id, сколько бы раз его ни пересылали.
+                            -- path - относительно корня хранилища; last_accessed_at - для вытеснения давно не нужных (LRU)
+                        CREATE TABLE IF NOT EXISTS bot_data.media_blobs (
+                            media_file_unique_id VARCHAR(255) PRIMARY KEY,
+                            path VARCHAR(512) NOT NULL,
+                            size_bytes BIGINT NOT NULL,
+                            media_type VARCHAR(50),
+                            mime_type VARCHAR(100),
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            last_accessed_at TIMESTAMP NOT NULL DEFAULT NOW()
+                            );
+
+                        CREATE INDEX IF NOT EXISTS idx_media_blobs_lru
+                        ON bot_data.media_blobs (last_accessed_at, media_file_unique_id);
+
+                            -- Какое медиа у какого сообщения. Без внешнего ключа: связь остается и после вытеснения файла
+                        CREATE TABLE IF NOT EXISTS bot_data.message_media (
+                            telegram_chat_id BIGINT NOT NULL,
+                            telegram_message_id BIGINT NOT NULL,
+                            media_file_unique_id VARCHAR(255) NOT NULL,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            PRIMARY KEY (telegram_chat_id, telegram_message_id)
+                            );
+
+                        CREATE INDEX IF NOT EXISTS idx_message_media_blob
+                        ON bot_data.message_media (media_file_unique_id);
+
+                            -- Апдейты, принятые через webhook: повторная доставка на любую реплику отбрасывается
+                        CREATE TABLE IF NOT EXISTS bot_data.processed_updates (
+                            update_id BIGINT PRIMARY KEY,
+                            processed_at TIMESTAMP NOT NULL DEFAULT NOW()
+                            );
         """
 
-        with pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(create_schema)
+        # Таблица из версий до секционирования остается как есть, пока миграцию не включат явно
+        cur.execute(self.MESSAGES_RELKIND_SQL)
+        row = cur.fetchone()
+        legacy = row is not None and row[0] != 'p'
+        migrate = legacy and self.migrate_messages
+        if migrate:
+            cur.execute('SET LOCAL statement_timeout = 0;')
+            cur.execute(self.DETACH_LEGACY_MESSAGES_SQL)
 
-    def add_task(self, task, executor_username, taskmaker_user_id, taskmaker_username):
+        # Агрегаты задач появились позже самих задач: при создании заполняем их по истории
+        cur.execute("SELECT to_regclass('bot_data.task_status_counts') IS NULL;")
+        build_task_stats = cur.fetchone()[0]
 
-        add_task_sql = """
-                        INSERT INTO bot_data.tasks (task,executor_user_id,executor_username, taskmaker_user_id ,taskmaker_username,status,created_dt)
-                        VALUES (%(task)s,(SELECT user_id FROM bot_data.users WHERE username = %(executor_username)s), %(executor_username)s,%(taskmaker_user_id)s ,%(taskmaker_username)s,%(status)s,%(created_dt)s)
-                        RETURNING id;
+        cur.execute(create_schema)
+
+        self.messages_partitioned = not legacy or migrate
+        if migrate:
+            self._copy_legacy_messages(cur)
+        if self.messages_partitioned:
+            self._create_message_partitions(cur, _month_start(datetime.now()), self.partitions_ahead)
+        else:
+            logger.info('⚠️ bot_data.group_messages не секционирована: '
+                        'для переноса в секции запустите бота с MESSAGES_PARTITION_MIGRATE=1')
+
+        # Привязка к чату переносит задачи между ключами агрегатов - пересобираем их
+        if self._backfill_task_chats(cur) or build_task_stats:
+            self._rebuild_task_stats(cur)
+
+        # В секционированной таблице уникальный ключ включает telegram_date;
+        # у правки сообщения date - исходная, так что повтор попадает в тот же ключ
+        if self.messages_partitioned:
+            conflict = 'telegram_message_id, telegram_chat_id, telegram_date'
+        else:
+            conflict = 'telegram_message_id, telegram_chat_id'
+        self.save_message_statement = PreparedStatement('save_message', f"""
+        INSERT INTO bot_data.group_messages ({', '.join(MessageRow._fields)})
+        VALUES ({', '.join(f'${number}' for number in range(1, len(MessageRow._fields) + 1))})
+        ON CONFLICT ({conflict})
+        DO UPDATE SET
+            message_text = EXCLUDED.message_text,
+            has_media = EXCLUDED.has_media,
+            media_type = EXCLUDED.media_type,
+            updated_at = NOW()
+        """)
+
+    UPSERT_USER = PreparedStatement('upsert_user', """
+                        INSERT INTO bot_data.users (user_id,username,first_name,last_name,is_bot,last_seen)
+                        VALUES ($1,$2,$3,$4,$5,$6)
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET
+                            username = EXCLUDED.username,
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name,
+                            last_seen = EXCLUDED.last_seen
+    """)
+    UPSERT_CHAT = PreparedStatement('upsert_chat', """
+                        INSERT INTO bot_data.chats (chat_id,chat_title,chat_type)
+                        VALUES ($1,$2,$3)
+                        ON CONFLICT (chat_id)
+                        DO UPDATE SET
+                            chat_title = EXCLUDED.chat_title,
+                            chat_type = EXCLUDED.chat_type
+    """)
+    # Без chat_id - любая задача, с chat_id - задача этого чата или старая задача без чата.
+    # Подзапрос блокирует строку и отдает статус до изменения - для агрегатов /stats.
+    # Параметр, который встречается дважды, приводится к типу явно и одинаково:
+    # иначе PREPARE выводит для него разные типы (text и varchar) и падает
+    CHANGE_STATUS = PreparedStatement('change_status', f"""
+                   UPDATE bot_data.tasks AS t
+                   SET status = $1::varchar, update_dt = $2::timestamp,
+                       done_dt = CASE WHEN $1::varchar IN {_sql_list(TASK_DONE_STATUSES)}
+                                      THEN COALESCE(t.done_dt, $2::timestamp) END
+                   FROM (SELECT id, status, done_dt FROM bot_data.tasks WHERE id = $3 FOR UPDATE) AS old
+                   WHERE t.id = old.id AND (t.chat_id IS NULL OR t.chat_id = COALESCE($4::bigint, t.chat_id))
+                   RETURNING t.chat_id, t.thread_id, t.executor_username, t.created_dt, old.status, old.done_dt, t.done_dt
+    """)
+    TASK_STATUS_COUNT = PreparedStatement('task_status_count', """
+                   INSERT INTO bot_data.task_status_counts (chat_id, executor_username, status, tasks)
+                   VALUES ($1, $2, $3, $4)
+                   ON CONFLICT (chat_id, executor_username, status)
+                   DO UPDATE SET tasks = bot_data.task_status_counts.tasks + EXCLUDED.tasks
+    """)
+    TASK_DAILY_STATS = PreparedStatement('task_daily_stats', """
+                   INSERT INTO bot_data.task_daily_stats (chat_id, executor_username, day, created, done, cycle_seconds)
+                   VALUES ($1, $2, $3, $4, $5, $6)
+                   ON CONFLICT (chat_id, executor_username, day)
+                   DO UPDATE SET created = bot_data.task_daily_stats.created + EXCLUDED.created,
+                                 done = bot_data.task_daily_stats.done + EXCLUDED.done,
+                                 cycle_seconds = bot_data.task_daily_stats.cycle_seconds + EXCLUDED.cycle_seconds
+    """)
+    ADD_TRANSACTION = PreparedStatement('add_transaction', """
+                   INSERT INTO bot_data.transactions (task_id,changer_user_id,changer_username,status,update_dt)
+                   VALUES ($1,$2,$3,$4,$5)
+    """)
+
+    MESSAGES_RELKIND_SQL = """
+                        SELECT c.relkind FROM pg_class c
+                        JOIN pg_namespace n ON n.oid = c.relnamespace
+                        WHERE n.nspname = 'bot_data' AND c.relname = 'group_messages';
+    """
+
+    # Имена ключей и индекса освобождаем для новой таблицы: они уникальны в пределах схемы
+    DETACH_LEGACY_MESSAGES_SQL = """
+                        ALTER TABLE bot_data.group_messages RENAME TO group_messages_legacy;
+                        ALTER TABLE bot_data.group_messages_legacy
+                            DROP CONSTRAINT IF EXISTS group_messages_pkey,
+                            DROP CONSTRAINT IF EXISTS unique_message_chat;
+                        DROP INDEX IF EXISTS bot_data.idx_group_messages_text;
+    """
+
+    # Задачи до привязки к чатам (chat_id IS NULL). Сообщение-команда не архивируется,
+    # поэтому чат выводим косвенно: единственный групповой чат, где писал постановщик,
+    # или единственный групповой чат бота вообще. Топик - если постановщик писал в одном
+    BACKFILL_TASK_CHATS_SQL = """
+                        WITH taskmaker_chats AS (
+                            SELECT sender_user_id,
+                                   MIN(telegram_chat_id) AS chat_id,
+                                   CASE WHEN COUNT(DISTINCT COALESCE(telegram_thread_id, 0)) = 1
+                                        THEN MIN(COALESCE(telegram_thread_id, 0)) ELSE 0 END AS thread_id
+                            FROM bot_data.group_messages
+                            WHERE sender_user_id IN (SELECT taskmaker_user_id FROM bot_data.tasks WHERE chat_id IS NULL)
+                            GROUP BY sender_user_id
+                            HAVING COUNT(DISTINCT telegram_chat_id) = 1
+                        )
+                        UPDATE bot_data.tasks AS t
+                        SET chat_id = c.chat_id, thread_id = c.thread_id
+                        FROM taskmaker_chats AS c
+                        WHERE t.chat_id IS NULL AND t.taskmaker_user_id = c.sender_user_id;
+
+                        WITH group_chats AS (
+                            SELECT chat_id FROM bot_data.chats WHERE chat_type IN ('group', 'supergroup')
+                        )
+                        UPDATE bot_data.tasks
+                        SET chat_id = (SELECT chat_id FROM group_chats), thread_id = 0
+                        WHERE chat_id IS NULL AND (SELECT COUNT(*) FROM group_chats) = 1;
+    """
+
+    def _backfill_task_chats(self, cur) -> bool:
+        """Привязывает старые задачи к чатам, где это выводится однозначно. True - что-то поменялось"""
+        cur.execute('SELECT COUNT(*) FROM bot_data.tasks WHERE chat_id IS NULL;')
+        before = cur.fetchone()[0]
+        if not before:
+            return False
+        cur.execute(self.BACKFILL_TASK_CHATS_SQL)
+        cur.execute('SELECT COUNT(*) FROM bot_data.tasks WHERE chat_id IS NULL;')
+        after = cur.fetchone()[0]
+        logger.info(f'🧭 Старые задачи без чата: привязано {before - after} из {before}; '
+                    f'остальные видны и меняются во всех чатах')
+        return after != before
+
+    def _copy_legacy_messages(self, cur) -> None:
+        cur.execute("SELECT min(telegram_date), max(telegram_date) FROM bot_data.group_messages_legacy;")
+        first, last = cur.fetchone()
+        if first is not None:
+            first, last = _month_start(first), _month_start(last)
+            months = (last.year - first.year) * 12 + last.month - first.month
+            self._create_message_partitions(cur, first, months)
+
+        cur.execute("""
+                        SELECT column_name FROM information_schema.columns
+                        WHERE table_schema = 'bot_data' AND table_name = 'group_messages_legacy'
+                        ORDER BY ordinal_position;
+        """)
+        columns = ', '.join(name for (name,) in cur.fetchall())
+        cur.execute(f"""
+                        INSERT INTO bot_data.group_messages ({columns})
+                        SELECT {columns} FROM bot_data.group_messages_legacy;
+        """)
+        copied = cur.rowcount
+        cur.execute("""
+                        SELECT setval(pg_get_serial_sequence('bot_data.group_messages', 'id'),
+                                      COALESCE((SELECT max(id) FROM bot_data.group_messages), 0) + 1, false);
+
+                        CREATE SCHEMA IF NOT EXISTS bot_archive;
+                        ALTER TABLE bot_data.group_messages_legacy SET SCHEMA bot_archive;
+        """)
+        logger.info(f'✅ В секции group_messages перенесено строк: {copied}, '
+                    f'старая таблица - bot_archive.group_messages_legacy, удалите ее после проверки')
+
+    def _create_message_partitions(self, cur, first: datetime, months: int) -> None:
+        """Создает секции с месяца first на months месяцев вперед и секцию по умолчанию"""
+        cur.execute("""
+                        CREATE TABLE IF NOT EXISTS bot_data.group_messages_default
+                        PARTITION OF bot_data.group_messages DEFAULT;
+        """)
+        for i in range(months + 1):
+            month = _add_months(first, i)
+            bounds = {'start': month, 'end': _add_months(month, 1)}
+            name = message_partition_name(month)
+
+            cur.execute("SELECT to_regclass(%(name)s) IS NOT NULL;", {'name': f'bot_data.{name}'})
+            if cur.fetchone()[0]:
+                continue
+
+            # Строки этого месяца могли попасть в секцию по умолчанию: новую секцию
+            # тогда собираем отдельно и подключаем, иначе Postgres ее не создаст
+            cur.execute("""
+                        SELECT EXISTS (SELECT 1 FROM bot_data.group_messages_default
+                                       WHERE telegram_date >= %(start)s AND telegram_date < %(end)s);
+            """, bounds)
+            if not cur.fetchone()[0]:
+                cur.execute(f"""
+                        CREATE TABLE bot_data.{name} PARTITION OF bot_data.group_messages
+                        FOR VALUES FROM (%(start)s) TO (%(end)s);
+                """, bounds)
+                continue
+
+            cur.execute(f"""
+                        CREATE TABLE bot_data.{name} (LIKE bot_data.group_messages INCLUDING DEFAULTS);
+
+                        WITH moved AS (
+                            DELETE FROM bot_data.group_messages_default
+                            WHERE telegram_date >= %(start)s AND telegram_date < %(end)s
+                            RETURNING *
+                        )
+                        INSERT INTO bot_data.{name} SELECT * FROM moved;
+
+                        ALTER TABLE bot_data.group_messages ATTACH PARTITION bot_data.{name}
+                        FOR VALUES FROM (%(start)s) TO (%(end)s);
+            """, bounds)
+            logger.info(f'📦 Секция {name} собрана из строк секции по умолчанию')
+
+    def _expire_message_partitions(self, cur) -> list:
+        """Отцепляет или удаляет секции старше retention_months, возвращает их имена"""
+        cutoff = _add_months(_month_start(datetime.now()), -self.retention_months)
+        cur.execute("""
+                        SELECT c.relname FROM pg_inherits i
+                        JOIN pg_class c ON c.oid = i.inhrelid
+                        WHERE i.inhparent = 'bot_data.group_messages'::regclass;
+        """)
+        expired = []
+        for (name,) in cur.fetchall():
+            if not name.startswith(MESSAGE_PARTITION_PREFIX):
+                continue
+            month = datetime.strptime(name[len(MESSAGE_PARTITION_PREFIX):], '%Y_%m')
+            if _add_months(month, 1) > cutoff:
+                continue
+
+            if self.retention_mode == 'drop':
+                cur.execute(f"DROP TABLE bot_data.{name};")
+            else:
+                cur.execute(f"""
+                        ALTER TABLE bot_data.group_messages DETACH PARTITION bot_data.{name};
+                        CREATE SCHEMA IF NOT EXISTS bot_archive;
+                        ALTER TABLE bot_data.{name} SET SCHEMA bot_archive;
+                """)
+            expired.append(name)
+        return expired
+
+    async def maintain_message_partitions(self) -> None:
+        """Создает секции group_messages наперед и применяет политику хранения"""
+
+        def _maintain(cur):
+            if not self.messages_partitioned:
+                return []
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (self.PARTITIONS_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                return []
+            # DDL над родительской таблицей ждет блокировки: не держим вставки в очереди за собой
+            cur.execute("SET LOCAL lock_timeout = '2s';")
+            self._create_message_partitions(cur, _month_start(datetime.now()), self.partitions_ahead)
+            if self.retention_months > 0:
+                return self._expire_message_partitions(cur)
+            return []
+
+        expired = await self.pg.run(_maintain, timeout_ms=0)
+        if expired:
+            action = 'удалены' if self.retention_mode == 'drop' else 'перенесены в bot_archive'
+            logger.info(f'🗄 Секции сообщений {action}: {", ".join(expired)}')
+
+    async def claim_update(self, update_id: int) -> bool:
+        """Отмечает апдейт как принятый. False - его уже обработала эта или другая реплика"""
+
+        claim_update_sql = """
+                        INSERT INTO bot_data.processed_updates (update_id) VALUES (%(update_id)s)
+                        ON CONFLICT (update_id) DO NOTHING
+                        RETURNING update_id;
         """
-        add_task_transaction_sql = """                
-                        INSERT INTO bot_data.transactions (task_id,changer_user_id,changer_username,status,update_dt)
-                        VALUES (%(task_id)s, %(taskmaker_user_id)s,%(taskmaker_username)s,%(status)s,%(update_dt)s);
+        rows = await self.pg.run(_fetchall, claim_update_sql, {'update_id': update_id})
+        return bool(rows)
+
+    async def prune_processed_updates(self, keep_hours: int = 48) -> None:
+        # Telegram хранит недоставленные апдейты сутки: старше этого повторов не бывает
+        prune_sql = """
+                        DELETE FROM bot_data.processed_updates
+                        WHERE processed_at < NOW() - make_interval(hours => %(keep_hours)s);
         """
+        await self.pg.run(_execute, prune_sql, {'keep_hours': keep_hours}, timeout_ms=0)
+
+    async def maintenance_forever(self, interval: float = 6 * 3600) -> None:
+        """Фоновое обслуживание: секции group_messages и журнал принятых апдейтов"""
+        while True:
+            try:
+                await self.maintain_message_partitions()
+            except Exception as e:
+                logger.error(f'❌ Обслуживание секций group_messages не удалось: {e}')
+            try:
+                await self.prune_processed_updates()
+            except Exception as e:
+                logger.error(f'❌ Не удалось очистить processed_updates: {e}')
+            await asyncio.sleep(interval)
 
+    async def add_task(self, task, executor_username, taskmaker_user_id, taskmaker_username, executor_user_id=None,
+                       chat_id=None, thread_id=None):
+
+        add_task_sql = """
+                        INSERT INTO bot_data.tasks (task,executor_user_id,executor_username, taskmaker_user_id ,taskmaker_username,status,created_dt,chat_id,thread_id)
+                        VALUES (%(task)s,
+                                COALESCE((SELECT user_id FROM bot_data.users WHERE user_id = %(executor_user_id)s),
+                                         (SELECT user_id FROM bot_data.users WHERE username = %(executor_username)s LIMIT 1)),
+                                %(executor_username)s,%(taskmaker_user_id)s ,%(taskmaker_username)s,%(status)s,%(created_dt)s,
+                                %(chat_id)s,%(thread_id)s)
+                        RETURNING id;
+        """
         params = {
 
             'task': task,
             'executor_username': executor_username,
+            'executor_user_id': executor_user_id,
             'status': '🔰',
             'created_dt': datetime.now(),
             'update_dt': datetime.now(),
             'taskmaker_user_id': taskmaker_user_id,
-            'taskmaker_username': taskmaker_username
+            'taskmaker_username': taskmaker_username,
+            'chat_id': chat_id,
+            'thread_id': thread_id
         }
+        scope = task_scope_key(chat_id, thread_id)
 
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(add_task_sql, params)
-                task_id = cur.fetchone()[0]
-                params['task_id'] = task_id
-                cur.execute(add_task_transaction_sql, params)
+        stats_key = (chat_id or 0, executor_username or '')
+
+        def _add_task(cur):
+            cur.execute(add_task_sql, params)
+            task_id = cur.fetchone()[0]
+            _execute_statements(cur, [
+                (self.ADD_TRANSACTION, (task_id, taskmaker_user_id, taskmaker_username, params['status'], params['update_dt'])),
+                (self.TASK_STATUS_COUNT, (*stats_key, params['status'], 1)),
+                (self.TASK_DAILY_STATS, (*stats_key, params['created_dt'].date(), 1, 0, 0)),
+            ])
+            self._notify_tasks_changed(cur, scope)
 
-    def show_all_tasks(self):
-        show_tasks_sql = """
-                        SELECT id, status, task, executor_username  FROM bot_data.tasks WHERE status != '🏁';
+        await self.pg.run(_add_task)
+        self._tasks_changed(scope)
+
+    async def show_tasks_page(self, after_id: int = 0, before_id: int = None, limit: int = 20,
+                              chat_id: int = None, thread_id: int = 0):
+        """Страница незавершенных задач по id (keyset): после after_id или перед before_id.
+
+        С chat_id - задачи этого чата и топика и старые задачи без чата, без него - по всем чатам.
+        Возвращает (rows, has_prev, has_next), rows отсортированы по id.
         """
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                try:
-                    cur.execute(show_tasks_sql)
-                    return cur.fetchall()
-                except:
-                    return False
+        scope_sql = '' if chat_id is None else \
+            'AND (chat_id IS NULL OR (chat_id = %(chat_id)s AND thread_id = %(thread_id)s))'
 
-    def change_status(self, task_id, status, changer_user_id, changer_username):
-        change_status_sql = """
-                   UPDATE bot_data.tasks SET status = %(status)s, update_dt = %(update_dt)s WHERE id = %(task_id)s;
+        next_page_sql = f"""
+                        SELECT id, status, task, executor_username FROM bot_data.tasks
+                        WHERE status != '🏁' {scope_sql} AND id > %(anchor)s
+                        ORDER BY id
+                        LIMIT %(limit)s;
+        """
+        prev_page_sql = f"""
+                        SELECT id, status, task, executor_username FROM bot_data.tasks
+                        WHERE status != '🏁' {scope_sql} AND id < %(anchor)s
+                        ORDER BY id DESC
+                        LIMIT %(limit)s;
+        """
+        has_before_sql = f"""
+                        SELECT EXISTS (SELECT 1 FROM bot_data.tasks WHERE status != '🏁' {scope_sql} AND id < %(anchor)s);
+        """
+        has_after_sql = f"""
+                        SELECT EXISTS (SELECT 1 FROM bot_data.tasks WHERE status != '🏁' {scope_sql} AND id > %(anchor)s);
+        """
+        scope = {'chat_id': chat_id, 'thread_id': thread_id}
 
-                   INSERT INTO bot_data.transactions (task_id,changer_user_id,changer_username,status,update_dt)
-                   VALUES (%(task_id)s,%(changer_user_id)s,%(changer_username)s,%(status)s,%(update_dt)s);
+        def _show_tasks_page(cur):
+            # Берем на одну строку больше, чтобы узнать, есть ли страница дальше
+            if before_id is None:
+                cur.execute(next_page_sql, dict(scope, anchor=after_id, limit=limit + 1))
+                rows = cur.fetchall()
+                has_next = len(rows) > limit
+                rows = rows[:limit]
+                if not rows:
+                    return rows, False, False
+                cur.execute(has_before_sql, dict(scope, anchor=rows[0][0]))
+                has_prev = cur.fetchone()[0]
+            else:
+                cur.execute(prev_page_sql, dict(scope, anchor=before_id, limit=limit + 1))
+                rows = cur.fetchall()
+                has_prev = len(rows) > limit
+                rows = rows[:limit][::-1]
+                if not rows:
+                    return rows, False, False
+                cur.execute(has_after_sql, dict(scope, anchor=rows[-1][0]))
+                has_next = cur.fetchone()[0]
+            return rows, has_prev, has_next
+
+        return await self.pg.run(_show_tasks_page)
+
+    async def change_status(self, task_id, status, changer_user_id, changer_username, chat_id=None):
+        """Меняет статус задачи. С chat_id - только если задача из этого чата. Возвращает, нашлась ли задача"""
+        update_dt = datetime.now()
+
+        def _change_status(cur):
+            self.CHANGE_STATUS.execute(cur, (status, update_dt, task_id, chat_id))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            task_chat_id, thread_id, executor_username, created_dt, old_status, old_done_dt, done_dt = row
+            statements = [(self.ADD_TRANSACTION, (task_id, changer_user_id, changer_username, status, update_dt))]
+            statements.extend(self._task_stats_changes(
+                (task_chat_id or 0, executor_username or ''), created_dt, old_status, status, old_done_dt, done_dt
+            ))
+            _execute_statements(cur, statements)
+            # Старая задача без чата видна во всех чатах: пустой ключ сбрасывает все кэши
+            scope = task_scope_key(task_chat_id, thread_id) if task_chat_id is not None else ''
+            self._notify_tasks_changed(cur, scope)
+            return scope
+
+        scope = await self.pg.run(_change_status)
+        if scope is None:
+            return False
+        self._tasks_changed(scope)
+        return True
+
+    def _task_stats_changes(self, key, created_dt, old_status, status, old_done_dt, done_dt) -> list:
+        """Изменения агрегатов /stats при смене статуса: перенос между счетчиками статусов,
+        а если задача стала сделанной или вернулась в работу - поток за день выполнения"""
+        if old_status == status:
+            return []
+        changes = [(self.TASK_STATUS_COUNT, (*key, status, 1))]
+        if old_status is not None:
+            changes.append((self.TASK_STATUS_COUNT, (*key, old_status, -1)))
+        if old_done_dt != done_dt:
+            if old_done_dt is not None:
+                changes.append((self.TASK_DAILY_STATS, (
+                    *key, old_done_dt.date(), 0, -1, -(old_done_dt - created_dt).total_seconds())))
+            if done_dt is not None:
+                changes.append((self.TASK_DAILY_STATS, (
+                    *key, done_dt.date(), 0, 1, (done_dt - created_dt).total_seconds())))
+        return changes
+
+    def _rebuild_task_stats(self, cur) -> None:
+        # Задачи, сделанные до появления done_dt: момент последнего перехода в ✅/🏁 по истории
+        done = _sql_list(TASK_DONE_STATUSES)
+        rebuild_sql = f"""
+                        UPDATE bot_data.tasks AS t
+                        SET done_dt = COALESCE((
+                            SELECT MIN(tr.update_dt) FROM bot_data.transactions AS tr
+                            WHERE tr.task_id = t.id AND tr.status IN {done}
+                              AND tr.update_dt >= COALESCE((
+                                  SELECT MAX(back.update_dt) FROM bot_data.transactions AS back
+                                  WHERE back.task_id = t.id AND back.status NOT IN {done}
+                              ), t.created_dt)
+                        ), t.update_dt, t.created_dt)
+                        WHERE t.status IN {done} AND t.done_dt IS NULL;
+
+                        UPDATE bot_data.tasks SET done_dt = NULL
+                        WHERE status NOT IN {done} AND done_dt IS NOT NULL;
+
+                        TRUNCATE bot_data.task_status_counts, bot_data.task_daily_stats;
+
+                        INSERT INTO bot_data.task_status_counts (chat_id, executor_username, status, tasks)
+                        SELECT COALESCE(chat_id, 0), COALESCE(executor_username, ''), status, COUNT(*)
+                        FROM bot_data.tasks
+                        WHERE status IS NOT NULL
+                        GROUP BY 1, 2, 3;
+
+                        INSERT INTO bot_data.task_daily_stats (chat_id, executor_username, day, created, done, cycle_seconds)
+                        SELECT chat_id, executor_username, day, SUM(created), SUM(done), SUM(cycle_seconds)
+                        FROM (
+                            SELECT COALESCE(chat_id, 0) AS chat_id, COALESCE(executor_username, '') AS executor_username,
+                                   created_dt::date AS day, 1 AS created, 0 AS done, 0::float8 AS cycle_seconds
+                            FROM bot_data.tasks
+                            UNION ALL
+                            SELECT COALESCE(chat_id, 0), COALESCE(executor_username, ''),
+                                   done_dt::date, 0, 1, EXTRACT(EPOCH FROM done_dt - created_dt)::float8
+                            FROM bot_data.tasks
+                            WHERE done_dt IS NOT NULL
+                        ) AS flow
+                        GROUP BY 1, 2, 3;
         """
-        params = {
-            'status': status,
-            'task_id': task_id,
-            'update_dt': datetime.now(),
-            'changer_user_id': changer_user_id,
-            'changer_username': changer_username
-        }
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(change_status_sql, params)
+        cur.execute('SET LOCAL statement_timeout = 0;')
+        # Смены статусов ждут конца пересборки, иначе их приращения потеряются при TRUNCATE
+        cur.execute('LOCK TABLE bot_data.tasks IN SHARE ROW EXCLUSIVE MODE;')
+        cur.execute(rebuild_sql)
+        logger.info('📊 Агрегаты задач пересобраны по истории')
+
+    async def rebuild_task_stats(self) -> None:
+        """Полная пересборка агрегатов /stats из bot_data.tasks - если они разошлись с задачами"""
+        await self.pg.run(self._rebuild_task_stats, timeout_ms=0)
+
+    async def task_stats(self, chat_id: int = None, days: int = 30):
+        """Агрегаты задач по (чат, исполнитель): открытые сейчас и поток за последние days дней.
+
+        Без chat_id - по всем чатам. Строки: (chat_id, chat_title, executor_username,
+        open_tasks, created, done, cycle_seconds).
+        """
+        closed = _sql_list(TASK_DONE_STATUSES + TASK_CANCELLED_STATUSES)
+        stats_sql = f"""
+                        WITH open AS (
+                            SELECT chat_id, executor_username, SUM(tasks) AS open_tasks
+                            FROM bot_data.task_status_counts
+                            WHERE status NOT IN {closed} AND (%(chat_id)s::bigint IS NULL OR chat_id = %(chat_id)s)
+                            GROUP BY 1, 2
+                        ), flow AS (
+                            SELECT chat_id, executor_username,
+                                   SUM(created) AS created, SUM(done) AS done, SUM(cycle_seconds) AS cycle_seconds
+                            FROM bot_data.task_daily_stats
+                            WHERE day > CURRENT_DATE - %(days)s AND (%(chat_id)s::bigint IS NULL OR chat_id = %(chat_id)s)
+                            GROUP BY 1, 2
+                        )
+                        SELECT chat_id, c.chat_title, executor_username,
+                               COALESCE(open_tasks, 0), COALESCE(created, 0), COALESCE(done, 0),
+                               COALESCE(cycle_seconds, 0)
+                        FROM open FULL JOIN flow USING (chat_id, executor_username)
+                        LEFT JOIN bot_data.chats AS c USING (chat_id)
+                        ORDER BY chat_id, executor_username;
+        """
+        params = {'chat_id': chat_id, 'days': days}
+        return await self.pg.run(_fetchall, stats_sql, params)
+
+    def on_tasks_changed(self, callback) -> None:
+        """callback(payload) вызывается после каждого add_task/change_status этого процесса"""
+        self._task_listeners.append(callback)
+
+    def _notify_tasks_changed(self, cur, payload: str = '') -> None:
+        # NOTIFY уходит другим инстансам только при коммите транзакции
+        cur.execute('SELECT pg_notify(%s, %s);', (self.TASKS_CHANNEL, payload))
 
-    def add_or_update_user(self,
+    def _tasks_changed(self, payload: str = '') -> None:
+        for callback in self._task_listeners:
+            callback(payload)
+
+    async def add_or_update_user(self,
                            user_id,
                            username,
                            first_name,
@@ -240,101 +1221,339 @@ class DataBase:
                            last_seen
                            ):
 
-        add_user_sql = """
-                        INSERT INTO bot_data.users (user_id,username,first_name,last_name,is_bot,last_seen)
-                        VALUES (%(user_id)s,%(username)s,%(first_name)s,%(last_name)s,%(is_bot)s,%(last_seen)s)
-                        ON CONFLICT (user_id) 
-                        DO UPDATE SET 
-                            username = EXCLUDED.username,
-                            first_name = EXCLUDED.first_name,
-                            last_name = EXCLUDED.last_name,
-                            last_seen = EXCLUDED.last_seen
-                            ;
+        def _add_or_update_user(cur):
+            # Оба upsert'а - одним обращением к серверу
+            _execute_statements(cur, [
+                (self.UPSERT_USER, (user_id, username, first_name, last_name, is_bot, last_seen)),
+                (self.UPSERT_CHAT, (chat_id, chat_title, chat_type)),
+            ])
 
-                        INSERT INTO bot_data.chats (chat_id,chat_title,chat_type)
-                        VALUES (%(chat_id)s,%(chat_title)s,%(chat_type)s)
-                        ON CONFLICT (chat_id) 
-                        DO UPDATE SET 
-                            chat_title = EXCLUDED.chat_title,
-                            chat_type = EXCLUDED.chat_type
-                            ;
-                    """
-        add_user_params = {
-            'user_id': user_id,
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name,
-            'chat_id': chat_id,
-            'chat_title': chat_title,
-            'chat_type': chat_type,
-            'is_bot': is_bot,
-            'last_seen': last_seen
-        }
+        await self.pg.run(_add_or_update_user)
 
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(add_user_sql, add_user_params)
-
-
-    def save_message(self, message_data) -> None:
-
-        sql = """
-        INSERT INTO bot_data.group_messages (
-            telegram_message_id, telegram_chat_id, telegram_thread_id,
-            sender_user_id, sender_username, sender_first_name, sender_last_name,
-            sender_is_bot, sender_language_code,
-            chat_type, chat_title, chat_is_forum,
-            message_type, message_text,
-            has_media, media_type, media_file_id, media_file_unique_id,
-            media_file_name, media_mime_type, media_file_size, media_duration,
-            media_width, media_height,
-            is_topic_message, is_reply, is_forwarded,
-            reply_to_message_id, reply_to_user_id,
-            forum_topic_name, forum_topic_icon_color,
-            forward_from_user_id, forward_from_user_name, forward_date,
-            telegram_date
-        ) VALUES (
-            %(telegram_message_id)s, %(telegram_chat_id)s, %(telegram_thread_id)s,
-            %(sender_user_id)s, %(sender_username)s, %(sender_first_name)s, %(sender_last_name)s,
-            %(sender_is_bot)s, %(sender_language_code)s,
-            %(chat_type)s, %(chat_title)s, %(chat_is_forum)s,
-            %(message_type)s, %(message_text)s,
-            %(has_media)s, %(media_type)s, %(media_file_id)s, %(media_file_unique_id)s,
-            %(media_file_name)s, %(media_mime_type)s, %(media_file_size)s, %(media_duration)s,
-            %(media_width)s, %(media_height)s,
-            %(is_topic_message)s, %(is_reply)s, %(is_forwarded)s,
-            %(reply_to_message_id)s, %(reply_to_user_id)s,
-            %(forum_topic_name)s, %(forum_topic_icon_color)s,
-            %(forward_from_user_id)s, %(forward_from_user_name)s, %(forward_date)s,
-            %(telegram_date)s
-        )
-        ON CONFLICT (telegram_message_id, telegram_chat_id) 
-        DO UPDATE SET
-            message_text = EXCLUDED.message_text,
-            has_media = EXCLUDED.has_media,
-            media_type = EXCLUDED.media_type,
-            updated_at = NOW()
-        ;
+    async def update_last_seen(self, rows) -> None:
+        """Пачкой обновляет last_seen пользователей, которые уже есть в БД"""
+
+        update_last_seen_sql = """
+                        UPDATE bot_data.users AS u
+                        SET last_seen = GREATEST(u.last_seen, v.last_seen)
+                        FROM (VALUES %s) AS v (user_id, last_seen)
+                        WHERE u.user_id = v.user_id;
         """
+        template = "(%(user_id)s::bigint, %(last_seen)s::timestamp)"
 
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, message_data)
+        def _update_last_seen(cur):
+            execute_values(cur, update_last_seen_sql, rows, template=template, page_size=len(rows))
+
+        await self.pg.run(_update_last_seen)
+
+
+    async def save_message(self, message_data) -> None:
+        await self.save_messages([message_data])
+
+    async def save_messages(self, messages) -> None:
+        """Пишет пачку MessageRow одним обращением к серверу: EXECUTE подготовленного upsert'а на строку"""
+
+        def _save_messages(cur):
+            self.save_message_statement.execute_many(cur, messages)
+
+        await self.pg.run(_save_messages)
 
+    async def media_text_update(self, chat_id, message_id, text: str, engine: str = None, model: str = None,
+                                status: str = 'done'):
+        await self.media_text_updates([{
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'engine': engine,
+            'model': model,
+            'status': status
+        }])
 
+    async def media_text_updates(self, rows) -> None:
+        """Пачкой записывает транскрипты в group_messages одним UPDATE ... FROM (VALUES).
 
-    def media_text_update(self, message_id, text: str):
+        Ключ - (chat_id, message_id): message_id уникален только в пределах чата,
+        и по этой паре идет уникальный индекс. text=None (status='failed') текст не трогает.
+        """
 
         media_text_update_sql = """
-                                UPDATE bot_data.group_messages SET message_text = %(text)s WHERE telegram_message_id = %(message_id)s;
+                                UPDATE bot_data.group_messages AS m
+                                SET message_text = COALESCE(v.text, m.message_text),
+                                    transcript_engine = COALESCE(v.engine, m.transcript_engine),
+                                    transcript_model = COALESCE(v.model, m.transcript_model),
+                                    transcript_status = v.status,
+                                    updated_at = NOW()
+                                FROM (VALUES %s) AS v (chat_id, message_id, text, engine, model, status)
+                                WHERE m.telegram_message_id = v.message_id AND m.telegram_chat_id = v.chat_id;
         """
-        media_text_update_params = {
-            "message_id": message_id,
-            "text": text
+        template = """(
+            %(chat_id)s::bigint, %(message_id)s::bigint, %(text)s::text,
+            %(engine)s::varchar, %(model)s::varchar, %(status)s::varchar
+        )"""
+
+        def _media_text_updates(cur):
+            execute_values(cur, media_text_update_sql, rows, template=template, page_size=len(rows))
+
+        await self.pg.run(_media_text_updates)
+
+    async def search_messages(self, chat_id: int, query: str, limit: int = 50):
+        """Полнотекстовый поиск по сообщениям чата через GIN-индекс idx_group_messages_text.
+
+        query - в синтаксисе websearch: слова, "фраза", -исключить, or.
+        Возвращает до limit строк по убыванию релевантности со сниппетом.
+        """
+        # Выражение to_tsvector должно совпадать с индексом буква в букву, иначе индекс не используется.
+        # ts_headline дорогой - считаем его только для отобранных строк
+        search_sql = """
+                        SELECT telegram_message_id, telegram_date, sender_username, sender_first_name, message_type,
+                               ts_headline('russian', message_text, q,
+                                           'StartSel=«, StopSel=», MaxWords=25, MinWords=8, MaxFragments=2')
+                        FROM (
+                            SELECT telegram_message_id, telegram_date, sender_username, sender_first_name,
+                                   message_type, message_text, q,
+                                   ts_rank(to_tsvector('russian', message_text), q) AS rank
+                            FROM bot_data.group_messages, websearch_to_tsquery('russian', %(query)s) AS q
+                            WHERE telegram_chat_id = %(chat_id)s
+                              AND to_tsvector('russian', message_text) @@ q
+                            ORDER BY rank DESC, telegram_date DESC
+                            LIMIT %(limit)s
+                        ) AS hits
+                        ORDER BY rank DESC, telegram_date DESC;
+        """
+        params = {'chat_id': chat_id, 'query': query, 'limit': limit}
+        return await self.pg.run(_fetchall, search_sql, params)
+
+    async def get_transcript(self, media_file_unique_id: str, model: str):
+
+        get_transcript_sql = """
+                        SELECT transcript FROM bot_data.transcripts
+                        WHERE media_file_unique_id = %(media_file_unique_id)s AND model = %(model)s;
+        """
+        params = {'media_file_unique_id': media_file_unique_id, 'model': model}
+        rows = await self.pg.run(_fetchall, get_transcript_sql, params)
+        return rows[0][0] if rows else None
+
+    async def save_transcript(self, media_file_unique_id: str, model: str, transcript: str) -> None:
+
+        save_transcript_sql = """
+                        INSERT INTO bot_data.transcripts (media_file_unique_id, model, transcript)
+                        VALUES (%(media_file_unique_id)s, %(model)s, %(transcript)s)
+                        ON CONFLICT (media_file_unique_id, model) DO NOTHING;
+        """
+        params = {'media_file_unique_id': media_file_unique_id, 'model': model, 'transcript': transcript}
+        await self.pg.run(_execute, save_transcript_sql, params)
+
+    LINK_MESSAGE_MEDIA_SQL = """
+                        INSERT INTO bot_data.message_media (telegram_chat_id, telegram_message_id, media_file_unique_id)
+                        VALUES (%(chat_id)s, %(message_id)s, %(media_file_unique_id)s)
+                        ON CONFLICT (telegram_chat_id, telegram_message_id)
+                        DO UPDATE SET media_file_unique_id = EXCLUDED.media_file_unique_id;
+    """
+
+    async def touch_media_blob(self, media_file_unique_id: str, chat_id: int = None, message_id: int = None):
+        """Путь файла в хранилище (и отметка обращения для LRU) или None.
+
+        С chat_id и message_id заодно связывает сообщение с этим файлом.
+        """
+        touch_sql = """
+                        UPDATE bot_data.media_blobs SET last_accessed_at = NOW()
+                        WHERE media_file_unique_id = %(media_file_unique_id)s
+                        RETURNING path;
+        """
+        params = {'media_file_unique_id': media_file_unique_id, 'chat_id': chat_id, 'message_id': message_id}
+
+        def _touch(cur):
+            cur.execute(touch_sql, params)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            if message_id is not None:
+                cur.execute(self.LINK_MESSAGE_MEDIA_SQL, params)
+            return row[0]
+
+        return await self.pg.run(_touch)
+
+    async def save_media_blob(self, media_file_unique_id: str, path: str, size_bytes: int, media_type: str = None,
+                              mime_type: str = None, chat_id: int = None, message_id: int = None) -> None:
+        save_blob_sql = """
+                        INSERT INTO bot_data.media_blobs (media_file_unique_id, path, size_bytes, media_type, mime_type)
+                        VALUES (%(media_file_unique_id)s, %(path)s, %(size_bytes)s, %(media_type)s, %(mime_type)s)
+                        ON CONFLICT (media_file_unique_id)
+                        DO UPDATE SET path = EXCLUDED.path, size_bytes = EXCLUDED.size_bytes, last_accessed_at = NOW();
+        """
+        params = {
+            'media_file_unique_id': media_file_unique_id,
+            'path': path,
+            'size_bytes': size_bytes,
+            'media_type': media_type,
+            'mime_type': mime_type,
+            'chat_id': chat_id,
+            'message_id': message_id
         }
-        with self.pg.connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(media_text_update_sql, media_text_update_params)
+
+        def _save(cur):
+            cur.execute(save_blob_sql, params)
+            if message_id is not None:
+                cur.execute(self.LINK_MESSAGE_MEDIA_SQL, params)
+
+        await self.pg.run(_save)
+
+    async def forget_media_blob(self, media_file_unique_id: str) -> None:
+        """Файла уже нет на диске - убираем запись, следующий запрос скачает его заново"""
+        forget_sql = "DELETE FROM bot_data.media_blobs WHERE media_file_unique_id = %(media_file_unique_id)s;"
+        await self.pg.run(_execute, forget_sql, {'media_file_unique_id': media_file_unique_id})
+
+    async def evict_media_blobs(self, max_bytes: int, target_bytes: int):
+        """Если хранилище больше max_bytes, удаляет записи давно не нужных файлов, пока не останется target_bytes.
+
+        Возвращает [(path, size_bytes)] удаленных записей - файлы удаляет вызывающий.
+        Пока вытесняет один инстанс, остальные получают [].
+        """
+        total_sql = "SELECT COALESCE(SUM(size_bytes), 0) FROM bot_data.media_blobs;"
+        # Строка уходит, если без нее и всех более старых хранилище все еще больше target_bytes
+        evict_sql = """
+                        DELETE FROM bot_data.media_blobs AS b
+                        USING (
+                            SELECT media_file_unique_id FROM (
+                                SELECT media_file_unique_id, size_bytes,
+                                       SUM(size_bytes) OVER (ORDER BY last_accessed_at, media_file_unique_id) AS freed
+                                FROM bot_data.media_blobs
+                            ) AS lru
+                            WHERE lru.freed - lru.size_bytes < %(excess)s
+                        ) AS victims
+                        WHERE b.media_file_unique_id = victims.media_file_unique_id
+                        RETURNING b.path, b.size_bytes;
+        """
+
+        def _evict(cur):
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (self.MEDIA_EVICTION_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                return []
+            cur.execute(total_sql)
+            total = cur.fetchone()[0]
+            if total <= max_bytes:
+                return []
+            cur.execute(evict_sql, {'excess': total - target_bytes})
+            return cur.fetchall()
+
+        return await self.pg.run(_evict)
+
+    async def enqueue_transcription(self, message_data, max_attempts: int = 5) -> None:
+
+        enqueue_sql = """
+                        INSERT INTO bot_data.transcription_jobs (
+                            telegram_message_id, telegram_chat_id, media_type,
+                            media_file_id, media_file_unique_id, media_file_name, media_duration,
+                            max_attempts
+                        ) VALUES (
+                            %(telegram_message_id)s, %(telegram_chat_id)s, %(media_type)s,
+                            %(media_file_id)s, %(media_file_unique_id)s, %(media_file_name)s, %(media_duration)s,
+                            %(max_attempts)s
+                        )
+                        ON CONFLICT (telegram_message_id, telegram_chat_id) DO NOTHING;
+        """
+        params = dict(message_data._asdict(), max_attempts=max_attempts)
+        await self.pg.run(_execute, enqueue_sql, params)
+
+    async def claim_transcription_job(self, worker_id: str, visibility_timeout: int):
+        """Забирает одно готовое задание и прячет его от других воркеров на visibility_timeout секунд"""
+
+        claim_sql = """
+                        UPDATE bot_data.transcription_jobs AS j
+                        SET status = 'running',
+                            attempts = j.attempts + 1,
+                            locked_by = %(worker_id)s,
+                            locked_until = NOW() + make_interval(secs => %(visibility_timeout)s),
+                            updated_at = NOW()
+                        WHERE j.id = (
+                            SELECT id FROM bot_data.transcription_jobs
+                            WHERE status IN ('pending', 'running')
+                              AND available_at <= NOW()
+                              AND (status = 'pending' OR locked_until < NOW())
+                              AND attempts < max_attempts
+                            ORDER BY available_at, id
+                            FOR UPDATE SKIP LOCKED
+                            LIMIT 1
+                        )
+                        RETURNING j.id, j.telegram_message_id, j.telegram_chat_id, j.media_type,
+                                  j.media_file_id, j.media_file_unique_id, j.media_file_name, j.media_duration,
+                                  j.attempts, j.max_attempts;
+        """
+        params = {'worker_id': worker_id, 'visibility_timeout': visibility_timeout}
+
+        def _claim(cur):
+            cur.execute(claim_sql, params)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column.name for column in cur.description], row))
+
+        return await self.pg.run(_claim)
+
+    async def extend_transcription_job(self, job_id: int, worker_id: str, visibility_timeout: int) -> None:
+
+        extend_sql = """
+                        UPDATE bot_data.transcription_jobs
+                        SET locked_until = NOW() + make_interval(secs => %(visibility_timeout)s), updated_at = NOW()
+                        WHERE id = %(job_id)s AND locked_by = %(worker_id)s AND status = 'running';
+        """
+        params = {'job_id': job_id, 'worker_id': worker_id, 'visibility_timeout': visibility_timeout}
+        await self.pg.run(_execute, extend_sql, params)
+
+    async def complete_transcription_job(self, job_id: int, worker_id: str) -> None:
+
+        complete_sql = """
+                        UPDATE bot_data.transcription_jobs
+                        SET status = 'done', locked_until = NULL, last_error = NULL, updated_at = NOW()
+                        WHERE id = %(job_id)s AND locked_by = %(worker_id)s;
+        """
+        await self.pg.run(_execute, complete_sql, {'job_id': job_id, 'worker_id': worker_id})
+
+    async def fail_transcription_job(self, job_id: int, worker_id: str, error: str, retry_delay: int) -> None:
+        """Возвращает задание в очередь с задержкой, после max_attempts попыток - в dead"""
+
+        fail_sql = """
+                        UPDATE bot_data.transcription_jobs
+                        SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'pending' END,
+                            available_at = NOW() + make_interval(secs => %(retry_delay)s),
+                            locked_until = NULL,
+                            last_error = %(error)s,
+                            updated_at = NOW()
+                        WHERE id = %(job_id)s AND locked_by = %(worker_id)s;
+        """
+        params = {'job_id': job_id, 'worker_id': worker_id, 'error': error, 'retry_delay': retry_delay}
+        await self.pg.run(_execute, fail_sql, params)
+
+    async def reap_transcription_jobs(self) -> int:
+        """Переводит в dead задания, чей воркер пропал на последней попытке.
+
+        Их сообщения получают transcript_status = 'failed' в том же запросе, иначе висят в pending.
+        """
+
+        reap_sql = """
+                        WITH reaped AS (
+                            UPDATE bot_data.transcription_jobs
+                            SET status = 'dead', last_error = COALESCE(last_error, 'visibility timeout expired'), updated_at = NOW()
+                            WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts
+                            RETURNING telegram_chat_id, telegram_message_id
+                        ), failed AS (
+                            UPDATE bot_data.group_messages AS m
+                            SET transcript_status = 'failed', updated_at = NOW()
+                            FROM reaped AS r
+                            WHERE m.telegram_chat_id = r.telegram_chat_id AND m.telegram_message_id = r.telegram_message_id
+                              AND m.transcript_status = 'pending'
+                        )
+                        SELECT COUNT(*) FROM reaped;
+        """
+
+        def _reap(cur):
+            cur.execute(reap_sql)
+            return cur.fetchone()[0]
+
+        return await self.pg.run(_reap)
+
+    def close(self) -> None:
+        self.pg.close()
 
 
 db = DataBase(PgConnect())
\ No newline at end of file
@@ -0,0 +1,59 @@
+import logging
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Whisper ждет моно 16 кГц
+SAMPLE_RATE = 16000
+
+
+def _ffmpeg_cmd(source: str, sr: int):
+    return [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        "-i", source,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr),
+        "pipe:1",
+    ]
+
+
+def _to_float32(pcm: bytes) -> np.ndarray:
+    return np.frombuffer(pcm, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def load_audio_file(file_path: str, sr: int = SAMPLE_RATE) -> np.ndarray:
+    out = subprocess.run(_ffmpeg_cmd(file_path, sr), capture_output=True, check=True).stdout
+    return _to_float32(out)
+
+
+def load_audio_bytes(data: bytes, sr: int = SAMPLE_RATE, spill_dir: str = None) -> np.ndarray:
+    """Декодирует файл из памяти через stdin/stdout ffmpeg в float32 без временных файлов.
+
+    mp4 с moov-атомом в конце нельзя разобрать из пайпа - такие файлы
+    один раз пишем во временный файл.
+    """
+    try:
+        out = subprocess.run(_ffmpeg_cmd("pipe:0", sr), input=data, capture_output=True, check=True).stdout
+        if out:
+            return _to_float32(out)
+    except subprocess.CalledProcessError as e:
+        logger.info(f'ffmpeg не смог декодировать поток из памяти, пишем на диск: {e.stderr[-200:]!r}')
+
+    with tempfile.NamedTemporaryFile(dir=spill_dir) as tmp:
+        tmp.write(data)
+        tmp.flush()
+        return load_audio_file(tmp.name, sr)
+
+
+def load_audio(source, sr: int = SAMPLE_RATE, spill_dir: str = None) -> np.ndarray:
+    """source - путь к файлу, bytes или уже декодированный массив"""
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        return load_audio_bytes(bytes(source), sr, spill_dir)
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    return load_audio_file(source, sr)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз повторять запись пачки при временной ошибке БД, пауза удваивается
+BATCH_RETRIES = int(os.getenv('BATCH_RETRIES', '3'))
+BATCH_RETRY_DELAY_MS = int(os.getenv('BATCH_RETRY_DELAY_MS', '200'))
+
+
+def is_transient(error: Exception) -> bool:
+    """Сбой соединения, таймаут, дедлок: та же пачка может записаться со второй попытки"""
+    return isinstance(error, (psycopg2.OperationalError, PoolError, ConnectionError, asyncio.TimeoutError))
+
+
+class BatchWriter:
+    """Копит строки и пишет их в БД одной пачкой: по размеру или по таймеру.
+
+    Временную ошибку БД пачка переживает повторами. Если пачка не пишется из-за
+    данных, она делится пополам, пока плохие строки не останутся по одной:
+    теряются только они.
+    """
+
+    def __init__(self, flush, key=None, max_size: int = 200, interval_ms: int = 500, name: str = 'batch',
+                 retries: int = BATCH_RETRIES, retry_delay_ms: int = BATCH_RETRY_DELAY_MS):
+        # flush - корутина, получающая list строк
+        # key - функция ключа строки: повторная строка с тем же ключом заменяет прежнюю
+        self._flush_fn = flush
+        self._key = key
+        self.max_size = max_size
+        self.interval = interval_ms / 1000
+        self.name = name
+        self.retries = retries
+        self.retry_delay = retry_delay_ms / 1000
+
+        self._rows = {}
+        self._seq = 0
+        # Ключ строки -> ее ожидающие: ошибка достается только тем, чьи строки не записались
+        self._waiters = {}
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row) -> asyncio.Future:
+        """Ставит строку в очередь. Future завершается, когда пачка с этой строкой записана"""
+        loop = asyncio.get_running_loop()
+
+        if self._key is not None:
+            key = self._key(row)
+            # Последняя версия строки уходит в конец пачки
+            self._rows.pop(key, None)
+        else:
+            self._seq += 1
+            key = self._seq
+        self._rows[key] = row
+
+        waiter = loop.create_future()
+        # Ошибку записи логирует flush(), вызывающему не обязательно ждать результат
+        waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._waiters.setdefault(key, []).append(waiter)
+
+        if len(self._rows) >= self.max_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._start_flush)
+
+        return waiter
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            items, self._rows = list(self._rows.items()), {}
+            waiters, self._waiters = self._waiters, {}
+            if not items:
+                return
+
+            failed = dict(await self._write(items))
+            if failed:
+                logger.error(f'❌ {self.name}: не записано {len(failed)} из {len(items)} строк')
+            else:
+                logger.info(f'✅ {self.name}: записано {len(items)} строк')
+            for key, key_waiters in waiters.items():
+                for waiter in key_waiters:
+                    if waiter.done():
+                        continue
+                    if key in failed:
+                        waiter.set_exception(failed[key])
+                    else:
+                        waiter.set_result(None)
+
+    async def _write_retrying(self, rows) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                await self._flush_fn(rows)
+                return
+            except Exception as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                logger.info(f'⚠️ {self.name}: пачка из {len(rows)} строк не записана ({e}), повтор через {delay:.1f} c')
+                await asyncio.sleep(delay)
+
+    async def _write(self, items) -> list:
+        """Пишет [(ключ, строка)]; возвращает [(ключ, ошибка)] того, что записать не удалось"""
+        try:
+            await self._write_retrying([row for _, row in items])
+            return []
+        except Exception as e:
+            if is_transient(e):
+                # БД недоступна - делить пачку бесполезно
+                logger.error(f'❌ {self.name}: не удалось записать пачку из {len(items)} строк: {e}')
+                return [(key, e) for key, _ in items]
+            if len(items) == 1:
+                logger.error(f'❌ {self.name}: строка {items[0][0]} не записана: {e}')
+                return [(items[0][0], e)]
+            middle = len(items) // 2
+            return await self._write(items[:middle]) + await self._write(items[middle:])
+
+    async def close(self) -> None:
+        """Дописывает всё, что осталось в буфере (при остановке бота)"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
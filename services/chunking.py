@@ -0,0 +1,168 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from services.audio import SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+# Записи длиннее порога режем по речи и распознаем кусками параллельно
+LONG_AUDIO_SECONDS = int(os.getenv('LONG_AUDIO_SECONDS', '120'))
+CHUNK_MAX_SECONDS = int(os.getenv('CHUNK_MAX_SECONDS', '30'))
+# Каждый процесс держит свою копию модели: учитывайте память
+CHUNK_PROCESSES = int(os.getenv('CHUNK_PROCESSES', str(max(1, (os.cpu_count() or 2) // 2))))
+
+VAD_FRAME_MS = 30
+# Паузы короче этого не разрывают речь
+VAD_MIN_SILENCE_MS = int(os.getenv('VAD_MIN_SILENCE_MS', '600'))
+# Всплески короче этого считаем шумом
+VAD_MIN_SPEECH_MS = int(os.getenv('VAD_MIN_SPEECH_MS', '250'))
+VAD_PADDING_MS = 200
+# Порог энергии относительно шумового фона записи
+VAD_THRESHOLD_RATIO = float(os.getenv('VAD_THRESHOLD_RATIO', '3.0'))
+VAD_MIN_RMS = 0.003
+# Если VAD нашел речи меньше этой доли записи (ровный уровень без пауз, шум), режем запись целиком
+VAD_MIN_COVERAGE = float(os.getenv('VAD_MIN_COVERAGE', '0.1'))
+
+
+def speech_segments(audio: np.ndarray, sr: int = SAMPLE_RATE):
+    """Энергетический VAD: список (start, end) в сэмплах с речью"""
+    frame = sr * VAD_FRAME_MS // 1000
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return []
+
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    noise_floor = np.percentile(rms, 10)
+    is_speech = rms > max(VAD_MIN_RMS, noise_floor * VAD_THRESHOLD_RATIO)
+
+    # Границы участков речи: переходы 0 -> 1 и 1 -> 0
+    edges = np.diff(np.concatenate(([0], is_speech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    min_silence = VAD_MIN_SILENCE_MS // VAD_FRAME_MS
+    min_speech = VAD_MIN_SPEECH_MS // VAD_FRAME_MS
+    padding = VAD_PADDING_MS * sr // 1000
+
+    segments = []
+    for start, end in zip(starts, ends):
+        if segments and start - segments[-1][1] < min_silence:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+
+    return [
+        (max(0, start * frame - padding), min(len(audio), end * frame + padding))
+        for start, end in segments
+        if end - start >= min_speech
+    ]
+
+
+def split_chunks(segments, max_samples: int):
+    """Склеивает соседние участки речи в куски не длиннее max_samples, длинные - режет.
+
+    Длинный участок делится поровну: 60.3 с при лимите 30 - три куска по 20.1 с,
+    а не 30 + 30 + обрывок, на котором модель галлюцинирует.
+    """
+    chunks = []
+    for start, end in segments:
+        pieces = -(-(end - start) // max_samples)
+        if pieces > 1:
+            size = -(-(end - start) // pieces)
+            chunks.extend((piece, min(piece + size, end)) for piece in range(start, end, size))
+            continue
+        if chunks and start - chunks[-1][1] <= max_samples // 10 and end - chunks[-1][0] <= max_samples:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.append((start, end))
+    return chunks
+
+
+def _timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def _init_chunk_process(processes: int) -> None:
+    # Дочерний процесс: своя доля ядер (иначе processes × cores потоков дерутся за CPU)
+    # и модель при старте, а не на первом куске
+    from services.engines import transcription_engine
+    if not transcription_engine.threads:
+        transcription_engine.threads = max(1, (os.cpu_count() or 1) // processes)
+    try:
+        import torch
+        torch.set_num_threads(transcription_engine.threads)
+    except ImportError:
+        pass
+    if transcription_engine.preload != 'off':
+        transcription_engine.get()
+
+
+def _transcribe_chunk(audio: np.ndarray) -> str:
+    # Выполняется в дочернем процессе: у него свой движок и своя модель
+    from services.engines import transcription_engine
+    return transcription_engine.transcribe(audio)
+
+
+class ChunkedTranscriber:
+    """Режет длинную запись по паузам и распознает куски параллельно в пуле процессов"""
+
+    def __init__(self, processes: int = CHUNK_PROCESSES, long_audio_seconds: int = LONG_AUDIO_SECONDS,
+                 chunk_seconds: int = CHUNK_MAX_SECONDS, sr: int = SAMPLE_RATE):
+        self.processes = processes
+        self.long_audio_samples = long_audio_seconds * sr
+        self.chunk_samples = chunk_seconds * sr
+        self.sr = sr
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def is_long(self, audio: np.ndarray) -> bool:
+        return self.processes > 0 and len(audio) > self.long_audio_samples
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # spawn: не форкаем процесс с потоками torch и event loop. Дочерний процесс
+                    # импортирует __main__ родителя заново - поэтому БД там готовится лениво (PgConnect.on_setup)
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.processes,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=_init_chunk_process,
+                        initargs=(self.processes,)
+                    )
+        return self._pool
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        segments = speech_segments(audio, self.sr)
+        speech = sum(end - start for start, end in segments)
+        if speech < len(audio) * VAD_MIN_COVERAGE:
+            # Пустой результат сохранился бы как готовая транскрипция: лучше распознать всё подряд
+            logger.info(f'🔪 VAD нашел {speech / self.sr:.0f} c речи из {len(audio) / self.sr:.0f} c, режем запись целиком')
+            segments = [(0, len(audio))]
+            speech = len(audio)
+        chunks = split_chunks(segments, self.chunk_samples)
+        logger.info(f'🔪 {len(audio) / self.sr:.0f} c записи -> {len(chunks)} кусков, речи {speech / self.sr:.0f} c')
+        if not chunks:
+            return ''
+
+        texts = self.pool().map(_transcribe_chunk, [audio[start:end] for start, end in chunks])
+        return '\n'.join(
+            f'[{_timestamp(start / self.sr)}] {text.strip()}'
+            for (start, _), text in zip(chunks, texts)
+            if text.strip()
+        )
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+chunked_transcriber = ChunkedTranscriber()
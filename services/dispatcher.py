@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+
+from telegram import MessageEntity, Update
+from telegram.ext import BaseUpdateProcessor
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов обрабатывается одновременно по всем чатам
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+# Сколько апдейтов всего может быть в работе и в очередях чатов
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', '1000'))
+# Сколько апдейтов одного чата может ждать своей очереди; лишние сообщения отбрасываются, 0 - без лимита.
+# Команды, задачи (@бот ...) и кнопки статусов встают в очередь всегда
+CHAT_QUEUE_LIMIT = int(os.getenv('CHAT_QUEUE_LIMIT', '100'))
+
+UPDATES_DROPPED = registry.counter(
+    'bot_updates_dropped_total', 'Апдейты, отброшенные из-за переполненной очереди чата')
+
+
+class _ChatQueue:
+    __slots__ = ('lock', 'pending')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельно по чатам, строго по порядку внутри чата.
+
+    Application создает задачу на каждый апдейт в порядке получения.
+    Семафор базового класса (max_concurrent_updates) ограничивает число
+    апдейтов в работе и в очередях. Дальше апдейт встает в очередь своего
+    чата (asyncio.Lock и семафоры отдают место в порядке ожидания) и только
+    потом занимает один из concurrency слотов выполнения: апдейты, ждущие
+    свой чат, не держат слоты других чатов.
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_backlog: int = UPDATE_BACKLOG,
+                 chat_queue_limit: int = CHAT_QUEUE_LIMIT):
+        super().__init__(max(max_backlog, concurrency))
+        self.concurrency = concurrency
+        self.chat_queue_limit = chat_queue_limit
+        # Ждут очереди чата или слота / выполняются
+        self.waiting = 0
+        self.running = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chats = {}
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        # Callback-кнопки идут в очередь чата сообщения: статус задачи меняется после ее создания
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return f'user:{update.effective_user.id}'
+        return None
+
+    @staticmethod
+    def _is_control(update) -> bool:
+        """Апдейты, меняющие задачи: их не отбрасываем, даже если очередь чата переполнена"""
+        if not isinstance(update, Update):
+            return False
+        if update.callback_query is not None:
+            return True
+        message = update.message
+        if message is None or not message.entities:
+            return False
+        # /команда или '@бот текст задачи @исполнитель' - первая entity в начале текста
+        first = message.entities[0]
+        return first.offset == 0 and first.type in (MessageEntity.BOT_COMMAND, MessageEntity.MENTION)
+
+    async def _run(self, coroutine) -> None:
+        async with self._slots:
+            self.waiting -= 1
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            self.waiting += 1
+            await self._run(coroutine)
+            return
+
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = _ChatQueue()
+
+        if self.chat_queue_limit and queue.pending >= self.chat_queue_limit and not self._is_control(update):
+            coroutine.close()
+            UPDATES_DROPPED.inc()
+            logger.warning(f'⚠️ Очередь чата {key} переполнена ({queue.pending}), '
+                           f'update {getattr(update, "update_id", "?")} отброшен')
+            return
+
+        queue.pending += 1
+        self.waiting += 1
+        try:
+            async with queue.lock:
+                await self._run(coroutine)
+        finally:
+            queue.pending -= 1
+            if queue.pending == 0:
+                del self._chats[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# whisper - openai-whisper (PyTorch FP32), faster-whisper - CTranslate2 с квантованием int8
+TRANSCRIBE_ENGINE = os.getenv('TRANSCRIBE_ENGINE', 'whisper')
+WHISPER_MODEL_NAME = os.getenv('WHISPER_MODEL', 'small')
+# eager - грузить при импорте, background - прогрев в фоне после старта,
+# lazy - при первой транскрипции, off - этот процесс модель не грузит никогда
+WHISPER_PRELOAD = os.getenv('WHISPER_PRELOAD', 'lazy')
+# 0 - число потоков по умолчанию у библиотеки
+TRANSCRIBE_THREADS = int(os.getenv('TRANSCRIBE_THREADS', '0'))
+# 1 - жадное декодирование, как было у model.transcribe() по умолчанию
+TRANSCRIBE_BEAM_SIZE = int(os.getenv('TRANSCRIBE_BEAM_SIZE', '1'))
+# Температуры для повторного декодирования, если результат не прошел пороги качества
+TRANSCRIBE_TEMPERATURES = tuple(float(t) for t in os.getenv('TRANSCRIBE_TEMPERATURES', '0.0,0.2,0.4,0.6,0.8,1.0').split(','))
+TRANSCRIBE_COMPUTE_TYPE = os.getenv('TRANSCRIBE_COMPUTE_TYPE', 'int8')
+
+
+def _package_version(package: str) -> str:
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+class TranscriptionEngine:
+    """Движок транскрипции: модель грузится при первом обращении, а не при импорте"""
+
+    engine = None
+    package = None
+    # Настоящее пакетное декодирование в transcribe_batch; без него микро-пакеты только добавляют ожидание
+    batched = False
+
+    def __init__(self, model_name: str = WHISPER_MODEL_NAME, preload: str = WHISPER_PRELOAD,
+                 threads: int = TRANSCRIBE_THREADS, beam_size: int = TRANSCRIBE_BEAM_SIZE,
+                 temperatures: tuple = TRANSCRIBE_TEMPERATURES):
+        self.model_name = model_name
+        self.preload = preload
+        self.threads = threads
+        self.beam_size = beam_size
+        self.temperatures = temperatures
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        """Движок с версией: пишется в каждый транскрипт"""
+        return f'{self.engine}-{_package_version(self.package)}'
+
+    @property
+    def key(self) -> str:
+        """Ключ кэша транскриптов: другой движок или модель - другой текст"""
+        return f'{self.name}:{self.model_name}'
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        if self._model is None:
+            if self.preload == 'off':
+                raise RuntimeError('Загрузка модели в этом процессе отключена (WHISPER_PRELOAD=off)')
+            with self._lock:
+                if self._model is None:
+                    started = time.monotonic()
+                    self._model = self._load()
+                    logger.info(f'✅ Модель {self.key} загружена за {time.monotonic() - started:.1f} c, '
+                                f'транскрипция готова')
+        return self._model
+
+    async def warm_up(self) -> None:
+        if self.preload == 'off' or self.ready:
+            return
+        logger.info(f'⏳ Модель {self.key} загружается в фоне, до готовности транскрипции ждут')
+        try:
+            await asyncio.to_thread(self.get)
+        except Exception as e:
+            logger.error(f'❌ Не удалось загрузить модель {self.key}: {e}')
+
+    def _load(self):
+        raise NotImplementedError
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        """audio - моно float32 16 кГц"""
+        raise NotImplementedError
+
+    def transcribe_batch(self, audios: list) -> list:
+        """Пачка коротких записей; по умолчанию - по одной"""
+        return [self.transcribe(audio) for audio in audios]
+
+
+class WhisperEngine(TranscriptionEngine):
+    engine = 'openai-whisper'
+    package = 'openai-whisper'
+    batched = True
+
+    def _load(self):
+        import torch
+        import whisper
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        return whisper.load_model(self.model_name, device='cpu')
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        result = self.get().transcribe(
+            audio,
+            beam_size=self.beam_size if self.beam_size > 1 else None,
+            temperature=self.temperatures,
+            fp16=False,
+        )
+        return result["text"]
+
+    def transcribe_batch(self, audios: list) -> list:
+        """Один проход энкодера и декодера по пачке записей до 30 секунд"""
+        import torch
+        import whisper
+
+        model = self.get()
+        mels = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels)
+            for audio in audios
+        ])
+        options = whisper.DecodingOptions(
+            fp16=False,
+            beam_size=self.beam_size if self.beam_size > 1 else None,
+            temperature=self.temperatures[0],
+            without_timestamps=True,
+        )
+        results = whisper.decode(model, mels, options)
+
+        texts = []
+        for audio, result in zip(audios, results):
+            # Те же пороги, что и в model.transcribe(): тишина дает пустой текст
+            # (иначе в кэш уйдет галлюцинация), при плохом результате -
+            # полный прогон с повышением температуры
+            if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+                texts.append('')
+            elif result.compression_ratio > 2.4 or result.avg_logprob < -1.0:
+                texts.append(self.transcribe(audio))
+            else:
+                texts.append(result.text)
+        return texts
+
+
+class FasterWhisperEngine(TranscriptionEngine):
+    engine = 'faster-whisper'
+    package = 'faster-whisper'
+
+    def __init__(self, *args, compute_type: str = TRANSCRIBE_COMPUTE_TYPE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compute_type = compute_type
+
+    @property
+    def key(self) -> str:
+        return f'{self.name}:{self.model_name}:{self.compute_type}'
+
+    def _load(self):
+        from faster_whisper import WhisperModel
+        return WhisperModel(
+            self.model_name,
+            device='cpu',
+            compute_type=self.compute_type,
+            cpu_threads=self.threads,
+        )
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        segments, _ = self.get().transcribe(
+            audio,
+            beam_size=self.beam_size,
+            temperature=list(self.temperatures),
+        )
+        # segments - генератор: декодирование идет по мере чтения
+        return ''.join(segment.text for segment in segments)
+
+
+ENGINES = {
+    'whisper': WhisperEngine,
+    'faster-whisper': FasterWhisperEngine,
+}
+
+
+def create_engine(name: str = TRANSCRIBE_ENGINE, **kwargs) -> TranscriptionEngine:
+    if name not in ENGINES:
+        raise ValueError(f'Неизвестный движок транскрипции: {name}')
+    return ENGINES[name](**kwargs)
+
+
+transcription_engine = create_engine()
+
+registry.gauge('transcribe_model_ready', 'Модель транскрипции загружена в этом процессе (1/0)',
+               fn=lambda: int(transcription_engine.ready))
+if transcription_engine.preload == 'eager':
+    transcription_engine.get()
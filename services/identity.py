@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from database import db
+from services.batcher import BatchWriter
+
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '10000'))
+# Через сколько секунд запись перепроверяется upsert'ом; 0 - не устаревает (один инстанс бота)
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '300'))
+LAST_SEEN_FLUSH_INTERVAL_MS = int(os.getenv('LAST_SEEN_FLUSH_INTERVAL_MS', '30000'))
+
+
+class IdentityCache:
+    """LRU последних записанных в БД пользователей и чатов.
+
+    Upsert в users/chats идёт только когда username, имя или название чата
+    изменились; last_seen копится и пишется в БД пачкой раз в интервал.
+
+    Кэш у каждой реплики свой: переименование A -> B на одной и обратно в A
+    на другой оставит в БД B. Поэтому записи живут ttl секунд - расхождение
+    чинит первый апдейт пользователя после истечения.
+    """
+
+    def __init__(self, db, max_size: int = IDENTITY_CACHE_SIZE, flush_interval_ms: int = LAST_SEEN_FLUSH_INTERVAL_MS,
+                 ttl: float = IDENTITY_CACHE_TTL):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._chats = OrderedDict()
+        self._last_seen = BatchWriter(
+            db.update_last_seen,
+            key=lambda row: row['user_id'],
+            max_size=max_size,
+            interval_ms=flush_interval_ms,
+            name='users.last_seen'
+        )
+
+    def _get(self, cache: OrderedDict, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if self.ttl and time.monotonic() >= expires_at:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+    def _put(self, cache: OrderedDict, key, value):
+        cache[key] = (value, time.monotonic() + self.ttl)
+        cache.move_to_end(key)
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    async def touch(self, user_id, username, first_name, last_name, chat_id, chat_title, chat_type, is_bot, last_seen):
+        user = (username, first_name, last_name, is_bot)
+        chat = (chat_title, chat_type)
+
+        if self._get(self._users, user_id) == user and self._get(self._chats, chat_id) == chat:
+            if last_seen is not None:
+                self._last_seen.add({'user_id': user_id, 'last_seen': last_seen})
+            return
+
+        await self.db.add_or_update_user(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            chat_id=chat_id,
+            chat_title=chat_title,
+            chat_type=chat_type,
+            is_bot=is_bot,
+            last_seen=last_seen
+        )
+        self._put(self._users, user_id, user)
+        self._put(self._chats, chat_id, chat)
+
+    async def close(self) -> None:
+        await self._last_seen.close()
+
+
+identity_cache = IdentityCache(db)
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Корень хранилища; по умолчанию - store/ внутри LOCAL_PATH
+MEDIA_STORE_PATH = os.getenv('MEDIA_STORE_PATH')
+# Сколько байт медиа держим на диске; 0 - без лимита
+MEDIA_STORE_MAX_BYTES = int(os.getenv('MEDIA_STORE_MAX_BYTES', str(10 * 1024 ** 3)))
+# Вытеснение освобождает место с запасом, до этой доли лимита, чтобы не запускаться на каждый файл
+MEDIA_STORE_EVICT_TO = float(os.getenv('MEDIA_STORE_EVICT_TO', '0.9'))
+# Не чаще, чем раз в столько секунд на процесс
+MEDIA_STORE_EVICT_INTERVAL = float(os.getenv('MEDIA_STORE_EVICT_INTERVAL', '60'))
+
+
+def _safe_name(value: str, fallback: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_-]', '', value or '')[:64] or fallback
+
+
+def blob_relpath(unique_id: str, ext: str) -> str:
+    """ab/cd/<unique_id>.<ext>: два уровня по 256 каталогов, ключ - хэш media_file_unique_id"""
+    digest = hashlib.sha1(unique_id.encode()).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], f'{_safe_name(unique_id, digest)}.{_safe_name(ext, "bin")}')
+
+
+class MediaStore:
+    """Медиафайлы на диске по media_file_unique_id, индекс и LRU - в bot_data.media_blobs.
+
+    Один и тот же файл, пересланный в разные чаты, скачивается и лежит один раз:
+    media_file_unique_id у Telegram одинаков для одного содержимого. Сообщения
+    связаны с файлами через bot_data.message_media. Каталог общий для бота и
+    воркеров транскрипции (один том), вытесняет его один инстанс за раз.
+    Вытеснение может удалить файл, который читатель только что получил из get():
+    читатель ловит FileNotFoundError и скачивает файл заново (MediaSaver.transcribe_async).
+    """
+
+    def __init__(self, db, root: str, max_bytes: int = MEDIA_STORE_MAX_BYTES,
+                 evict_to: float = MEDIA_STORE_EVICT_TO, evict_interval: float = MEDIA_STORE_EVICT_INTERVAL):
+        self.db = db
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        self.evict_interval = evict_interval
+        self._evicted_at = 0.0
+        self._evicting = False
+        self._tasks = set()
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+
+    def path(self, relpath: str) -> str:
+        return os.path.join(self.root, relpath)
+
+    def spill_path(self, ext: str) -> str:
+        """Временный файл для скачивания на диск; put() переносит его на место"""
+        return os.path.join(self.root, 'tmp', f'{uuid.uuid4().hex}.{_safe_name(ext, "bin")}')
+
+    async def get(self, unique_id: str, chat_id: int = None, message_id: int = None):
+        """Путь к файлу, если он уже в хранилище, иначе None"""
+        if not unique_id:
+            return None
+        try:
+            relpath = await self.db.touch_media_blob(unique_id, chat_id, message_id)
+        except Exception as e:
+            logger.info(f'{unique_id}: индекс хранилища медиа недоступен: {e}')
+            return None
+        if relpath is None:
+            return None
+        path = self.path(relpath)
+        if not os.path.exists(path):
+            logger.info(f'⚠️ {unique_id}: файла {path} нет на диске, скачаем заново')
+            try:
+                await self.db.forget_media_blob(unique_id)
+            except Exception as e:
+                logger.info(f'{unique_id}: не удалось убрать запись из индекса: {e}')
+            return None
+        logger.info(f'♻️ {unique_id}: взят из хранилища медиа')
+        return path
+
+    def _write(self, source, path: str) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(source, str):
+            os.replace(source, path)
+        else:
+            # Пишем рядом и переименовываем: читатель не увидит недописанный файл
+            tmp = f'{path}.{uuid.uuid4().hex}.part'
+            try:
+                with open(tmp, 'wb') as out:
+                    out.write(source)
+                os.replace(tmp, path)
+            finally:
+                # После replace его уже нет; остался - запись упала, недописанный файл не нужен
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return os.path.getsize(path)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def put(self, unique_id: str, ext: str, source, media_type: str = None, mime_type: str = None,
+                  chat_id: int = None, message_id: int = None):
+        """Кладет скачанный файл в хранилище. source - bytes или путь из spill_path().
+
+        Возвращает то, из чего читать дальше: bytes остаются bytes (декодировать из
+        памяти дешевле) и пишутся на диск в фоне, путь - уже путь в хранилище
+        (переименование, без копирования).
+        """
+        relpath = blob_relpath(unique_id, ext)
+        if isinstance(source, (bytes, bytearray)):
+            self._spawn(self._persist(unique_id, relpath, source, media_type, mime_type, chat_id, message_id))
+            return source
+        return await self._persist(unique_id, relpath, source, media_type, mime_type, chat_id, message_id)
+
+    async def _persist(self, unique_id: str, relpath: str, source, media_type, mime_type, chat_id, message_id):
+        path = self.path(relpath)
+        try:
+            size = await asyncio.to_thread(self._write, source, path)
+        except OSError as e:
+            logger.error(f'❌ {unique_id}: не удалось записать в хранилище медиа: {e}')
+            return source
+        result = source if isinstance(source, (bytes, bytearray)) else path
+
+        try:
+            await self.db.save_media_blob(unique_id, relpath, size, media_type, mime_type, chat_id, message_id)
+        except Exception as e:
+            # Файл без записи в индексе не считается в лимите; следующий get() его не найдет и перезапишет
+            logger.error(f'❌ {unique_id}: не удалось записать в индекс хранилища медиа: {e}')
+            return result
+        logger.info(f'💾 {unique_id}: {size} байт в хранилище медиа')
+
+        self._spawn(self.maybe_evict())
+        return result
+
+    async def close(self) -> None:
+        """Дожидается фоновых записей и вытеснения"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def maybe_evict(self) -> None:
+        if not self.max_bytes or self._evicting or time.monotonic() - self._evicted_at < self.evict_interval:
+            return
+        self._evicting = True
+        self._evicted_at = time.monotonic()
+        try:
+            await self.evict()
+        except Exception as e:
+            logger.error(f'❌ Не удалось вытеснить медиа из хранилища: {e}')
+        finally:
+            self._evicting = False
+
+    async def evict(self) -> int:
+        """Удаляет давно не нужные файлы, если хранилище больше лимита. Возвращает освобожденные байты"""
+        victims = await self.db.evict_media_blobs(self.max_bytes, int(self.max_bytes * self.evict_to))
+        if not victims:
+            return 0
+        await asyncio.to_thread(self._remove, [relpath for relpath, _ in victims])
+        freed = sum(size for _, size in victims)
+        logger.info(f'🧹 Из хранилища медиа вытеснено {len(victims)} файлов, {freed} байт')
+        return freed
+
+    def _remove(self, relpaths) -> None:
+        for relpath in relpaths:
+            try:
+                os.remove(self.path(relpath))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.info(f'{relpath}: не удалось удалить: {e}')
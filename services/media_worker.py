@@ -1,16 +1,63 @@
 from telegram import Update
 from dotenv import load_dotenv
 load_dotenv()
-import whisper
-import os
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import os
+import time
 import logging
 
+from services.batcher import BatchWriter
+from services.scheduler import transcription_scheduler, MicroBatcher, SchedulerFull, TRANSCRIBE_BATCH_SIZE, TRANSCRIBE_BATCH_WAIT_MS
+from services.audio import load_audio, SAMPLE_RATE
+from services.metrics import TRANSCRIBE_LATENCY, TRANSCRIBE_RTF, TRANSCRIBE_AUDIO, MEDIA_DOWNLOAD_BYTES
+from services.engines import transcription_engine
+from services.chunking import chunked_transcriber
+from services.media_store import MediaStore, MEDIA_STORE_PATH
+
 
 logger = logging.getLogger(__name__)
 
-WHISPER_MODEL = whisper.load_model("small")
+# Скачивать аудио в память и декодировать через пайп ffmpeg, без временных файлов
+DISKLESS_MEDIA = os.getenv('DISKLESS_MEDIA', '1') == '1'
+# Файлы больше порога все равно пишем на диск
+MEDIA_SPILL_BYTES = int(os.getenv('MEDIA_SPILL_BYTES', str(20 * 1024 * 1024)))
+
+# Сколько медиа одновременно скачивается и распознается в процессе: остальные ждут, не занимая память
+MEDIA_INFLIGHT_LIMIT = int(os.getenv('MEDIA_INFLIGHT_LIMIT', '8'))
+# Переполненный планировщик (TRANSCRIBE_OVERFLOW=reject): столько повторов с удвоением паузы
+TRANSCRIBE_REJECT_RETRIES = int(os.getenv('TRANSCRIBE_REJECT_RETRIES', '3'))
+TRANSCRIBE_REJECT_DELAY = float(os.getenv('TRANSCRIBE_REJECT_DELAY', '1'))
+
+# Записи не длиннее порога распознаются пачками (окно whisper - 30 секунд)
+SHORT_CLIP_SECONDS = int(os.getenv('SHORT_CLIP_SECONDS', '25'))
+
+# Транскрипты пишутся в group_messages пачками: один UPDATE на N строк или M мс
+TRANSCRIPT_BATCH_SIZE = int(os.getenv('TRANSCRIPT_BATCH_SIZE', '100'))
+TRANSCRIPT_BATCH_INTERVAL_MS = int(os.getenv('TRANSCRIPT_BATCH_INTERVAL_MS', '200'))
+
+# Медиа, из которых извлекаем текст
+TRANSCRIBABLE_MEDIA_TYPES = ('voice', 'video_note', 'audio', 'video')
+
+DEFAULT_EXTENSIONS = {
+    'photo': 'jpg',
+    'audio': 'mp3',
+    'video': 'mp4',
+    'document': 'bin',
+    'voice': 'ogg',
+    'video_note': 'mp4',
+}
+
+
+def media_extension(media_type: str, file_name: str = None) -> str:
+    if file_name and media_type in ('audio', 'video', 'document'):
+        return file_name.split('.')[-1]
+    return DEFAULT_EXTENSIONS[media_type]
+
+def observe_transcription(path: str, seconds: float, audio_seconds: float) -> None:
+    TRANSCRIBE_LATENCY.observe(seconds, path=path)
+    TRANSCRIBE_AUDIO.inc(audio_seconds, path=path)
+    if audio_seconds > 0:
+        TRANSCRIBE_RTF.observe(seconds / audio_seconds, path=path)
 
 class MediaSaver:
     def __init__(self, db, storage_path: str = str(os.getenv('LOCAL_PATH'))):
@@ -18,85 +65,253 @@ class MediaSaver:
         self.db = db
         self.storage_path = storage_path
         os.makedirs(storage_path, exist_ok=True)
-        self.model = WHISPER_MODEL
-        self._executor = ThreadPoolExecutor(max_workers=2)
+        self.store = MediaStore(db, MEDIA_STORE_PATH or os.path.join(storage_path, 'store'))
+        self.engine = transcription_engine
+        # Один планировщик на процесс: общий лимит одновременных прогонов модели
+        self.scheduler = transcription_scheduler
+        # Слот берется до скачивания и держится до конца распознавания
+        self.inflight = asyncio.Semaphore(MEDIA_INFLIGHT_LIMIT)
+        self.batcher = MicroBatcher(
+            self.scheduler,
+            self._transcribe_batch_sync,
+            max_batch=TRANSCRIBE_BATCH_SIZE,
+            max_wait_ms=TRANSCRIBE_BATCH_WAIT_MS
+        )
+        self.transcripts = BatchWriter(
+            db.media_text_updates,
+            key=lambda row: (row['chat_id'], row['message_id']),
+            max_size=TRANSCRIPT_BATCH_SIZE,
+            interval_ms=TRANSCRIPT_BATCH_INTERVAL_MS,
+            name='group_messages.transcripts'
+        )
 
     async def save_group_media(self, update: Update, context):
         message = update.effective_message
+        chat_id = message.chat_id
         message_id = message.message_id
         mime_type = None
+        duration = None
         if message.photo:
-            file = await message.photo[-1].get_file()
-            ext = "jpg"
+            media = message.photo[-1]
+            ext = media_extension('photo')
+            media_type = 'photo'
         elif message.audio:
-            file = await message.audio.get_file()
-            ext = message.audio.file_name.split('.')[-1] if message.audio.file_name else "mp3"
-            mime_type = 'audio'
+            media = message.audio
+            ext = media_extension('audio', message.audio.file_name)
+            media_type = mime_type = 'audio'
+            duration = message.audio.duration
         elif message.video:
-            file = await message.video.get_file()
-            ext = message.video.file_name.split('.')[-1] if message.video.file_name else "mp4"
-            mime_type = 'video'
+            media = message.video
+            ext = media_extension('video', message.video.file_name)
+            media_type = mime_type = 'video'
+            duration = message.video.duration
         elif message.document:
-            file = await message.document.get_file()
-            ext = message.document.file_name.split('.')[-1] if message.document.file_name else "bin"
-            mime_type = 'document'
+            media = message.document
+            ext = media_extension('document', message.document.file_name)
+            media_type = mime_type = 'document'
         elif message.voice:
-            file = await message.voice.get_file()
-            ext = "ogg"
-            mime_type = 'voice'
+            media = message.voice
+            ext = media_extension('voice')
+            media_type = mime_type = 'voice'
+            duration = message.voice.duration
         elif message.video_note:
-            file = await message.video_note.get_file()
-            ext = "mp4"
-            mime_type = 'video_note'
+            media = message.video_note
+            ext = media_extension('video_note')
+            media_type = mime_type = 'video_note'
+            duration = message.video_note.duration
         else:
             return None
+        unique_id = media.file_unique_id
+        transcribable = mime_type in TRANSCRIBABLE_MEDIA_TYPES
+
+        # Пересланный файл уже распознавали - не скачиваем и не гоняем модель
+        if transcribable and await self.apply_cached_transcript(unique_id, chat_id, message_id):
+            await self.store.get(unique_id, chat_id, message_id)
+            return None
+
+        async with self.inflight:
+            await self._save_media(media, unique_id, media_type, ext, mime_type, chat_id, message_id, duration)
 
-        filename = f"message_id_{message_id}.{ext}"
-        logger.info(self.storage_path)
-        file_path = os.path.join(self.storage_path,  filename)
-        logger.info(file_path)
+    async def _save_media(self, media, unique_id, media_type, ext, mime_type, chat_id, message_id, duration):
+        """Скачивание и распознавание под слотом inflight. SchedulerFull уходит вызывающему"""
+        transcribable = mime_type in TRANSCRIBABLE_MEDIA_TYPES
         try:
-            await file.download_to_drive(file_path)
+            source = await self.fetch(media.get_file, unique_id, media_type, ext,
+                                      getattr(media, 'mime_type', None), chat_id, message_id)
         except Exception as e:
             logger.info(e)
-
+            if transcribable:
+                await self.mark_transcript_failed(chat_id, message_id)
+            return None
 
         # Добавь запись в БД и очередь обработки
         logger.info({
             "START" : " 🔄",
-            "file_path": file_path,
-            "message_id": message.message_id,
+            "file_path": source if isinstance(source, str) else "memory",
+            "message_id": message_id,
             "mime_type": mime_type
         })
 
+        if transcribable:
+            refetch = lambda: self.fetch(media.get_file, unique_id, media_type, ext,
+                                         getattr(media, 'mime_type', None), chat_id, message_id)
+            try:
+                await self.extract_text_from_media(source,mime_type,chat_id,message_id,duration,unique_id,refetch)
+            except SchedulerFull:
+                raise
+            except Exception as e:
+                logger.info(e)
+
+    async def fetch(self, get_file, unique_id: str, media_type: str, ext: str, mime_type: str = None,
+                    chat_id: int = None, message_id: int = None):
+        """Медиа из хранилища, а если его там нет - из Telegram с сохранением в хранилище.
+
+        get_file - корутина, возвращающая telegram.File: вызывается только при промахе.
+        Возвращает путь к файлу или bytes (скачанное в память так и декодируется).
+        """
+        path = await self.store.get(unique_id, chat_id, message_id)
+        if path is not None:
+            return path
+        file = await get_file()
+        spill_path = self.store.spill_path(ext)
+        try:
+            source = await self.download(file, spill_path)
+        except Exception:
+            if os.path.exists(spill_path):
+                os.remove(spill_path)
+            raise
+        return await self.store.put(unique_id, ext, source, media_type, mime_type, chat_id, message_id)
+
+    async def download(self, file, file_path: str):
+        """Скачивает файл в память (bytes) или, если он больше порога, на диск (путь)"""
+        if DISKLESS_MEDIA and (file.file_size or 0) <= MEDIA_SPILL_BYTES:
+            data = bytes(await file.download_as_bytearray())
+            MEDIA_DOWNLOAD_BYTES.observe(len(data), target='memory')
+            return data
+        await file.download_to_drive(file_path)
+        MEDIA_DOWNLOAD_BYTES.observe(os.path.getsize(file_path), target='disk')
+        return file_path
+
+    async def write_transcript(self, chat_id: int, message_id: int, text: str, status: str = 'done') -> None:
+        """Ставит транскрипт в пачку и ждет, пока пачка записана"""
+        await self.transcripts.add({
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'engine': self.engine.name if text is not None else None,
+            'model': self.engine.model_name if text is not None else None,
+            'status': status
+        })
+
+    async def mark_transcript_failed(self, chat_id: int, message_id: int) -> None:
         try:
-            await self.extract_text_from_media(file_path,mime_type,message_id)
-            os.remove(file_path)
-            logger.info(f'REMOVED FILE {file_path}')
+            await self.write_transcript(chat_id, message_id, None, status='failed')
         except Exception as e:
-            logger.info(e)
+            logger.info(f'message_id:{message_id} не удалось отметить неудачную транскрипцию: {e}')
 
+    async def apply_cached_transcript(self, unique_id: str, chat_id: int, message_id: int) -> bool:
+        if not unique_id:
+            return False
+        try:
+            text = await self.db.get_transcript(unique_id, self.engine.key)
+            if text is None:
+                return False
+            await self.write_transcript(chat_id, message_id, text)
+        except Exception as e:
+            logger.info(f'message_id:{message_id} кэш транскриптов недоступен: {e}')
+            return False
+        logger.info(f'♻️message_id:{message_id} транскрипт взят из кэша')
+        return True
+
+    async def remember_transcript(self, unique_id: str, text: str) -> None:
+        if not unique_id:
+            return
+        try:
+            await self.db.save_transcript(unique_id, self.engine.key, text)
+        except Exception as e:
+            logger.info(f'{unique_id}: не удалось сохранить транскрипт в кэш: {e}')
 
-    async def extract_text_from_media(self,file_path: str, mime_type: str,message_id : int) -> str:
+    async def extract_text_from_media(self,source, mime_type: str, chat_id: int, message_id : int, duration: int = None, unique_id: str = None, refetch=None) -> str:
         if mime_type.startswith('voice') or mime_type.startswith('video_note') or mime_type.startswith('audio') or mime_type.startswith('video'):
             # Асинхронная транскрипция
             try:
-                text = await self.transcribe_async(file_path)
-                self.db.media_text_update(message_id, text)
+                text = await self.transcribe_retrying(source, duration, refetch)
+                await self.write_transcript(chat_id, message_id, text)
+                await self.remember_transcript(unique_id, text)
                 logger.info(f'✅message_id:{message_id} saved to database')
+            except SchedulerFull:
+                # Не failed: вызывающий отдаст запись в очередь заданий
+                raise
             except Exception as e:
                 logger.info(f'❌message_id:{message_id} cannot be saved with error: \n{e}\n')
+                await self.mark_transcript_failed(chat_id, message_id)
 
 
-    async def transcribe_async(self, file_path):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            self._executor,
-            self._transcribe_sync,
-            file_path
-        )
+    async def transcribe_retrying(self, source, duration: int = None, refetch=None):
+        """transcribe_async с повторами, пока планировщик отказывает из-за переполнения"""
+        for attempt in range(TRANSCRIBE_REJECT_RETRIES + 1):
+            try:
+                return await self.transcribe_async(source, duration, refetch)
+            except SchedulerFull:
+                if attempt == TRANSCRIBE_REJECT_RETRIES:
+                    raise
+                await asyncio.sleep(TRANSCRIBE_REJECT_DELAY * 2 ** attempt)
+
+    async def transcribe_async(self, source, duration: int = None, refetch=None):
+        """refetch - корутина, заново достающая медиа (как fetch), если файл успели вытеснить"""
+        try:
+            return await self._submit_transcription(source, duration)
+        except FileNotFoundError:
+            # Вытеснение удалило файл между store.get() и чтением: запись в индексе уже
+            # снята, поэтому повторный fetch скачает его заново. Один раз
+            if refetch is None or not isinstance(source, str):
+                raise
+            logger.info(f'⚠️ {source}: файл вытеснен из хранилища до чтения, скачиваем заново')
+            return await self._submit_transcription(await refetch(), duration)
+
+    async def _submit_transcription(self, source, duration: int = None):
+        # Короткие записи идут раньше длинных; время постановки не дает длинным голодать
+        priority = time.monotonic() + (duration or 0)
+        if self.engine.batched and TRANSCRIBE_BATCH_SIZE > 1 and duration and duration <= SHORT_CLIP_SECONDS:
+            return await self.batcher.submit(source, priority=priority)
+        return await self.scheduler.submit(self._transcribe_sync, source, priority=priority)
+
+    def _transcribe_sync(self, source):
+        # Модель получает готовый float32-массив: декодирование в том же потоке планировщика
+        audio = load_audio(source, spill_dir=self.storage_path)
+        started = time.perf_counter()
+        # Длинные записи: без тишины, кусками параллельно в пуле процессов
+        if chunked_transcriber.is_long(audio):
+            path = 'chunked'
+            text = chunked_transcriber.transcribe(audio)
+        else:
+            path = 'single'
+            text = self.engine.transcribe(audio)
+        observe_transcription(path, time.perf_counter() - started, len(audio) / SAMPLE_RATE)
+        return text
+
+    def _transcribe_batch_sync(self, sources):
+        # Битый файл не должен валить всю пачку: его ошибка уходит только ему
+        results = [None] * len(sources)
+        audios = []
+        for i, source in enumerate(sources):
+            try:
+                audios.append((i, load_audio(source, spill_dir=self.storage_path)))
+            except Exception as e:
+                results[i] = e
+
+        if audios:
+            started = time.perf_counter()
+            texts = self.engine.transcribe_batch([audio for _, audio in audios])
+            for (i, _), text in zip(audios, texts):
+                results[i] = text
+            observe_transcription('batch', time.perf_counter() - started,
+                                  sum(len(audio) for _, audio in audios) / SAMPLE_RATE)
+        logger.info(f'📦 Пачка из {len(sources)} коротких записей распознана')
+        return results
 
-    def _transcribe_sync(self, file_path):
-        return self.model.transcribe(file_path)["text"]
+    async def close(self) -> None:
+        await self.store.close()
+        await self.transcripts.close()
 
 
@@ -0,0 +1,297 @@
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Эндпоинт /metrics в текстовом формате Prometheus; 0 - не поднимать
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Секунды: от быстрых запросов к БД до долгих транскрипций
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5)
+SIZE_BUCKETS = tuple(2 ** power for power in range(10, 28, 2))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Метрика с метками. Пишут в нее и event loop, и потоки executor'ов"""
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """Значение задается set() или считается при каждом чтении функцией fn"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                yield self.name, '', self.fn()
+            except Exception as e:
+                logger.info(f'{self.name}: не удалось прочитать значение: {e}')
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики по корзинам (без накопления), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, key, le), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, key), total
+            yield f'{self.name}_count', _format_labels(self.labelnames, key), count
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=(), fn=None) -> Gauge:
+        gauge = self._register(Gauge, name, documentation, labelnames)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.histogram(
+    'bot_handler_seconds', 'Время обработки апдейта хендлером', ('handler',))
+HANDLER_ERRORS = registry.counter(
+    'bot_handler_errors_total', 'Исключения в хендлерах', ('handler',))
+DB_LATENCY = registry.histogram(
+    'db_query_seconds', 'Время метода DataBase, включая ожидание соединения', ('method',))
+DB_ERRORS = registry.counter(
+    'db_query_errors_total', 'Ошибки методов DataBase', ('method',))
+DB_WAIT = registry.histogram(
+    'db_executor_wait_seconds', 'Ожидание свободного потока и соединения PgConnect')
+TRANSCRIBE_LATENCY = registry.histogram(
+    'transcribe_seconds', 'Время распознавания без ожидания в очереди', ('path',))
+TRANSCRIBE_RTF = registry.histogram(
+    'transcribe_realtime_factor', 'Время распознавания / длительность записи', ('path',), buckets=RTF_BUCKETS)
+TRANSCRIBE_AUDIO = registry.counter(
+    'transcribe_audio_seconds_total', 'Распознано секунд аудио', ('path',))
+MEDIA_DOWNLOAD_BYTES = registry.histogram(
+    'media_download_bytes', 'Размер скачанных медиафайлов', ('target',), buckets=SIZE_BUCKETS)
+
+
+def instrument_handler(callback):
+    """Обертка PTB-хендлера: гистограмма времени и счетчик исключений по имени функции"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+def instrument_methods(exclude=()):
+    """Декоратор класса: время и ошибки каждого публичного async-метода (db_query_seconds).
+
+    exclude - бесконечные фоновые циклы и прочее, что не является запросом.
+    """
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not asyncio.iscoroutinefunction(method):
+                continue
+            setattr(cls, name, _timed_method(name, method))
+        return cls
+
+    return decorate
+
+
+def _timed_method(name: str, method):
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(method=name)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, method=name)
+
+    return wrapper
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/metrics', '/'):
+            status, content_type = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+            body = registry.render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Поднимает /metrics в текущем event loop. None - эндпоинт отключен (port=0) или не поднялся.
+
+    Если порт занят (второй процесс на той же машине без своего METRICS_PORT),
+    берет свободный порт: процесс из-за метрик не падает.
+    """
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_serve, host, port)
+    except OSError as e:
+        logger.warning(f'⚠️ Метрики: не удалось занять {host}:{port} ({e}), задайте METRICS_PORT; берем свободный порт')
+        try:
+            server = await asyncio.start_server(_serve, host, 0)
+        except OSError as e:
+            logger.error(f'❌ Метрики отключены: {e}')
+            return None
+        port = server.sockets[0].getsockname()[1]
+    logger.info(f'📈 Метрики: http://{host}:{port}/metrics')
+    return server
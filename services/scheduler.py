@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIBE_WORKERS = int(os.getenv('TRANSCRIBE_WORKERS', '2'))
+TRANSCRIBE_QUEUE_SIZE = int(os.getenv('TRANSCRIBE_QUEUE_SIZE', '100'))
+# reject - сразу ошибка, defer - ждать места в очереди, drop_oldest - вытеснить самое старое задание
+TRANSCRIBE_OVERFLOW = os.getenv('TRANSCRIBE_OVERFLOW', 'defer')
+# Микро-пачки коротких записей: 1 - без пачек
+TRANSCRIBE_BATCH_SIZE = int(os.getenv('TRANSCRIBE_BATCH_SIZE', '8'))
+TRANSCRIBE_BATCH_WAIT_MS = int(os.getenv('TRANSCRIBE_BATCH_WAIT_MS', '300'))
+
+OVERFLOW_POLICIES = ('reject', 'defer', 'drop_oldest')
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class TranscriptionScheduler:
+    """Общий на процесс планировщик транскрипций.
+
+    Ограничивает число одновременных прогонов модели, держит очередь
+    ограниченного размера и отдает задания по приоритету (меньше - раньше).
+    """
+
+    def __init__(self, workers: int = TRANSCRIBE_WORKERS, max_queue: int = TRANSCRIBE_QUEUE_SIZE,
+                 overflow: str = TRANSCRIBE_OVERFLOW):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Неизвестная политика переполнения: {overflow}')
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.running = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transcribe')
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = None
+        self._runners = []
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+
+    def start(self):
+        """Запускает исполнителей в текущем event loop; повторный вызов ничего не делает"""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        if not self._runners:
+            self._runners = [asyncio.ensure_future(self._run()) for _ in range(self.workers)]
+
+    def _drop_oldest(self):
+        oldest = min(range(len(self._heap)), key=lambda i: self._heap[i][1])
+        _, seq, _, _, future = self._heap.pop(oldest)
+        heapq.heapify(self._heap)
+        if not future.done():
+            future.set_exception(SchedulerFull('Задание вытеснено из переполненной очереди'))
+        logger.info(f'⚠️ Очередь транскрипций переполнена, вытеснено задание #{seq}')
+
+    async def submit(self, fn, *args, priority: float = 0):
+        """Выполняет fn(*args) в пуле транскрипции и возвращает результат"""
+        self.start()
+        loop = asyncio.get_running_loop()
+
+        async with self._cond:
+            while len(self._heap) >= self.max_queue:
+                if self.overflow == 'reject':
+                    raise SchedulerFull(f'Очередь транскрипций заполнена ({self.max_queue})')
+                if self.overflow == 'drop_oldest':
+                    self._drop_oldest()
+                    break
+                await self._cond.wait()
+
+            future = loop.create_future()
+            heapq.heappush(self._heap, (priority, next(self._seq), fn, args, future))
+            self._cond.notify_all()
+
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._cond:
+                while not self._heap:
+                    await self._cond.wait()
+                _, _, fn, args, future = heapq.heappop(self._heap)
+                self._cond.notify_all()
+
+            # Вызывающий мог уже отказаться от результата
+            if future.done():
+                continue
+
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self._executor, fn, *args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+
+    def close(self) -> None:
+        for runner in self._runners:
+            runner.cancel()
+        self._runners = []
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MicroBatcher:
+    """Собирает короткие записи за max_wait_ms и отдает их в планировщик одной пачкой.
+
+    fn получает список элементов и возвращает список результатов того же
+    размера; результат-исключение уходит только своему вызывающему.
+    """
+
+    def __init__(self, scheduler: TranscriptionScheduler, fn, max_batch: int, max_wait_ms: int):
+        self.scheduler = scheduler
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item, priority: float = 0):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, priority, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        items = [item for item, _, _ in batch]
+        # Пачка идет с приоритетом самого срочного элемента
+        priority = min(priority for _, priority, _ in batch)
+        try:
+            results = await self.scheduler.submit(self.fn, items, priority=priority)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+transcription_scheduler = TranscriptionScheduler()
+
+registry.gauge('transcribe_queue_depth', 'Задания транскрипции в очереди планировщика',
+               fn=lambda: transcription_scheduler.queued)
+registry.gauge('transcribe_running', 'Транскрипции, выполняющиеся сейчас',
+               fn=lambda: transcription_scheduler.running)
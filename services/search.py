@@ -0,0 +1,128 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import db
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '5'))
+# Сколько лучших совпадений берем из БД за один запрос; страницы листаются по ним
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', '50'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '60'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '256'))
+SNIPPET_MAX_CHARS = 400
+
+MESSAGE_TYPE_ICONS = {
+    'voice': '🎤',
+    'video_note': '📹',
+    'video': '🎬',
+    'audio': '🎵',
+    'document': '📎',
+    'photo': '🖼',
+}
+
+
+class SearchView(NamedTuple):
+    text: str
+    reply_markup: Optional[InlineKeyboardMarkup]
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+def query_from_text(text: str) -> Optional[str]:
+    """Запрос из заголовка страницы результатов: «запрос»"""
+    match = re.match(r'🔎 «(.+?)»', text or '')
+    return match.group(1) if match else None
+
+
+def search_token(chat_id: int, query: str) -> str:
+    """Короткий ключ поиска для callback_data (лимит Telegram - 64 байта)"""
+    return hashlib.sha1(f'{chat_id}:{query}'.encode()).hexdigest()[:12]
+
+
+def render_hit(number: int, row) -> str:
+    message_id, telegram_date, username, first_name, message_type, snippet = row
+    author = f'@{username}' if username else (first_name or '?')
+    icon = MESSAGE_TYPE_ICONS.get(message_type, '💬')
+    snippet = ' '.join((snippet or '').split())
+    if len(snippet) > SNIPPET_MAX_CHARS:
+        snippet = snippet[:SNIPPET_MAX_CHARS] + '…'
+    return f'{number}. {icon} {telegram_date:%d.%m.%Y %H:%M} {author}\n{snippet}\n'
+
+
+class MessageSearch:
+    """Поиск по архиву сообщений чата с коротким кэшем результатов.
+
+    Ранжированный список берется из БД один раз, листание страниц и
+    повтор того же запроса в течение ttl в БД не ходят.
+    """
+
+    def __init__(self, db, ttl: int = SEARCH_CACHE_TTL, max_size: int = SEARCH_CACHE_SIZE,
+                 page_size: int = SEARCH_PAGE_SIZE, max_results: int = SEARCH_MAX_RESULTS):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.page_size = page_size
+        self.max_results = max_results
+        # token -> (expires_at, query, rows)
+        self._results = OrderedDict()
+
+    def _get(self, token: str):
+        entry = self._results.get(token)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._results[token]
+            return None
+        self._results.move_to_end(token)
+        return entry
+
+    async def search(self, chat_id: int, query: str) -> SearchView:
+        query = normalize_query(query)
+        token = search_token(chat_id, query)
+        if self._get(token) is None:
+            rows = await self.db.search_messages(chat_id, query, limit=self.max_results)
+            self._results[token] = (time.monotonic() + self.ttl, query, rows)
+            if len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+        return self.page(token, 0)
+
+    def page(self, token: str, page: int) -> Optional[SearchView]:
+        """None - результаты устарели, поиск нужно повторить"""
+        entry = self._get(token)
+        if entry is None:
+            return None
+        _, query, rows = entry
+
+        if not rows:
+            return SearchView(f'🔎 По запросу «{query}» ничего не найдено', None)
+
+        pages = (len(rows) + self.page_size - 1) // self.page_size
+        page = min(max(page, 0), pages - 1)
+        start = page * self.page_size
+        hits = '\n'.join(
+            render_hit(number, row)
+            for number, row in enumerate(rows[start:start + self.page_size], start=start + 1)
+        )
+        more = '+' if len(rows) >= self.max_results else ''
+        text = f'🔎 «{query}»: найдено {len(rows)}{more}, стр. {page + 1}/{pages}\n\n{hits}'
+
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("⬅️", callback_data=f"search_{token}_{page - 1}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("➡️", callback_data=f"search_{token}_{page + 1}"))
+        return SearchView(text, InlineKeyboardMarkup([buttons]) if buttons else None)
+
+
+message_search = MessageSearch(db)
@@ -0,0 +1,83 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from telegram import Message, MessageEntity
+
+MAX_EXECUTORS = 2
+
+EXECUTOR_ENTITY_TYPES = (MessageEntity.MENTION, MessageEntity.TEXT_MENTION)
+
+
+@dataclass
+class Executor:
+    username: str
+    user_id: Optional[int] = None
+
+    @property
+    def display(self) -> str:
+        # text_mention может указывать на пользователя без username
+        return f'@{self.username}' if self.user_id is None else self.username
+
+
+@dataclass
+class TaskCommand:
+    task: str = ''
+    executors: List[Executor] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def _utf16_slice(encoded: bytes, start: int, end: int = None) -> str:
+    # Смещения entities в Telegram считаются в UTF-16 code units
+    return encoded[start * 2:None if end is None else end * 2].decode('utf-16-le')
+
+
+def parse_task_command(message: Message, bot_username: str) -> Optional[TaskCommand]:
+    """Разбирает '@bot текст задачи @исполнитель [@исполнитель]' по entities сообщения.
+
+    Возвращает None, если сообщение не адресовано боту.
+    """
+    text = message.text
+    # Быстрый отказ: команда всегда начинается с упоминания бота
+    if not text or text[0] != '@' or not message.entities:
+        return None
+
+    first = message.entities[0]
+    if first.type != MessageEntity.MENTION or first.offset != 0:
+        return None
+
+    encoded = text.encode('utf-16-le')
+    if _utf16_slice(encoded, 1, first.length).lower() != bot_username.lower():
+        return None
+
+    executors = []
+    task_end = None
+    for entity in message.entities[1:]:
+        if entity.type not in EXECUTOR_ENTITY_TYPES:
+            continue
+        if entity.type == MessageEntity.TEXT_MENTION:
+            user = entity.user
+            executor = Executor(username=user.username or user.first_name, user_id=user.id)
+        else:
+            username = _utf16_slice(encoded, entity.offset + 1, entity.offset + entity.length)
+            if username.lower() == bot_username.lower():
+                continue
+            executor = Executor(username=username)
+
+        if task_end is None:
+            task_end = entity.offset
+        if executor not in executors:
+            executors.append(executor)
+
+    task = _utf16_slice(encoded, first.length, task_end).strip().lower()
+
+    if not task and not executors:
+        # Пустое обращение к боту: пусть бот покажет подсказку
+        return TaskCommand()
+    if not executors:
+        return TaskCommand(task=task, error='Надо добавить исполнителя')
+    if len(executors) > MAX_EXECUTORS:
+        return TaskCommand(task=task, executors=executors, error='У задачи не может быть больше двух исполнителей')
+    if not task:
+        return TaskCommand(executors=executors, error='Задача не может быть пустой!')
+
+    return TaskCommand(task=task, executors=executors)
@@ -0,0 +1,119 @@
+"""Статистика задач для /stats по агрегатам bot_data.task_status_counts и task_daily_stats.
+
+Агрегаты обновляются в транзакциях add_task/change_status. Если они разошлись
+с задачами (ручные правки в БД, сбой старой версии), их пересобирают по истории:
+
+    python -m services.task_stats --rebuild
+"""
+import argparse
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import NamedTuple
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# За сколько последних дней считать поток задач и время цикла
+TASK_STATS_DAYS = int(os.getenv('TASK_STATS_DAYS', '30'))
+TASK_STATS_MAX_DAYS = 365
+# Строк в ответе: исполнителей в чате или чатов в сводке по всем
+TASK_STATS_MAX_ROWS = int(os.getenv('TASK_STATS_MAX_ROWS', '30'))
+
+
+class StatsLine(NamedTuple):
+    name: str
+    open_tasks: int
+    created: int
+    done: int
+    cycle_seconds: float
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f'{minutes} мин'
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f'{hours} ч {minutes} мин'
+    days, hours = divmod(hours, 24)
+    return f'{days} д {hours} ч'
+
+
+def parse_days(args) -> int:
+    """/stats 7 - за неделю; без аргумента или с мусором - TASK_STATS_DAYS"""
+    for arg in args or ():
+        if arg.isdigit():
+            return min(max(int(arg), 1), TASK_STATS_MAX_DAYS)
+    return TASK_STATS_DAYS
+
+
+def _sum_lines(name: str, lines) -> StatsLine:
+    return StatsLine(
+        name,
+        sum(line.open_tasks for line in lines),
+        sum(line.created for line in lines),
+        sum(line.done for line in lines),
+        sum(line.cycle_seconds for line in lines),
+    )
+
+
+def render_line(line: StatsLine) -> str:
+    cycle = f', цикл {format_duration(line.cycle_seconds / line.done)}' if line.done else ''
+    return f'{line.name}: открыто {line.open_tasks}, создано {line.created}, сделано {line.done}{cycle}'
+
+
+def render_stats(rows, days: int, all_chats: bool = False) -> str:
+    """rows - из DataBase.task_stats. В чате - по исполнителям, по всем чатам - по чатам"""
+    if not rows:
+        return '📊 Задач пока нет'
+
+    # Чаты с одинаковым названием не склеиваются: ключ - chat_id
+    groups = defaultdict(list)
+    for chat_id, chat_title, executor_username, open_tasks, created, done, cycle_seconds in rows:
+        if all_chats:
+            key, name = chat_id, chat_title or (str(chat_id) if chat_id else 'без чата')
+        else:
+            key = name = f'@{executor_username}' if executor_username else 'без исполнителя'
+        groups[key].append(StatsLine(name, int(open_tasks), int(created), int(done), float(cycle_seconds)))
+
+    lines = sorted((_sum_lines(group[0].name, group) for group in groups.values()),
+                   key=lambda line: (-line.open_tasks, -line.done, line.name))
+    total = _sum_lines('Всего', lines)
+
+    scope = 'по всем чатам' if all_chats else 'в чате'
+    text = f'📊 Задачи {scope}, поток за {days} дн.\n\n{render_line(total)}\n\n'
+    text += '\n'.join(render_line(line) for line in lines[:TASK_STATS_MAX_ROWS])
+    if len(lines) > TASK_STATS_MAX_ROWS:
+        text += f'\n… и еще {len(lines) - TASK_STATS_MAX_ROWS}'
+    return text
+
+
+async def chat_stats(chat_id, days: int) -> str:
+    """chat_id=None - сводка по всем чатам"""
+    rows = await db.task_stats(chat_id=chat_id, days=days)
+    return render_stats(rows, days, all_chats=chat_id is None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Агрегаты задач для /stats')
+    parser.add_argument('--rebuild', action='store_true', help='пересобрать агрегаты по bot_data.tasks')
+    parser.add_argument('--days', type=int, default=TASK_STATS_DAYS)
+    args = parser.parse_args()
+
+    async def run():
+        if args.rebuild:
+            await db.rebuild_task_stats()
+        print(await chat_stats(None, args.days))
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run())
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import db, task_scope_key
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+TASKS_PAGE_SIZE = int(os.getenv('TASKS_PAGE_SIZE', '20'))
+TASK_VIEW_CACHE_SIZE = int(os.getenv('TASK_VIEW_CACHE_SIZE', '1000'))
+
+STATUS_BUTTONS = [
+    [("🔄 Начали", "🔄"), ("❌ Отменена", "❌")],
+    [("✅ Выполнена", "✅"), ("🔰 Новая", "🔰")],
+    [("🏁 Завершена", "🏁")],
+]
+
+
+# Суффикс callback_data для списка по всем чатам (только администраторам)
+ALL_CHATS_SUFFIX = '_all'
+
+
+def task_scope(message) -> tuple:
+    """(chat_id, thread_id) области задач: топик форума или весь чат"""
+    thread_id = message.message_thread_id if message.is_topic_message else 0
+    return message.chat_id, thread_id or 0
+
+
+class TaskView(NamedTuple):
+    text: str
+    reply_markup: InlineKeyboardMarkup
+
+
+def render_tasks(rows) -> str:
+    answer = ''
+    for i in rows:
+        answer += f'{i[0]}. {i[1]}- {i[2]} ({i[3]})\n'
+    return answer
+
+
+def page_buttons(view: str, rows, has_prev: bool, has_next: bool, suffix: str = ''):
+    # Курсор страницы - id крайней задачи, а не номер страницы
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"{view}_before_{rows[0][0]}{suffix}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"{view}_after_{rows[-1][0]}{suffix}"))
+    return buttons
+
+
+def tasks_keyboard(rows, has_prev: bool, has_next: bool, suffix: str = ''):
+    # after-курсор, с которого эта же страница строится заново
+    page = rows[0][0] - 1
+    keyboard = []
+    nav = page_buttons('tasks', rows, has_prev, has_next, suffix)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([
+        InlineKeyboardButton("Изменить статус задачи", callback_data=f"pick_after_{page}{suffix}")
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def picker_keyboard(rows, has_prev: bool, has_next: bool, suffix: str = ''):
+    page = rows[0][0] - 1
+    tasks_numbers = [i[0] for i in rows]
+    # Создаем сетку 4 колонки
+    columns = 4
+    keyboard = []
+
+    for i in range(0, len(tasks_numbers), columns):
+        row_numbers = tasks_numbers[i:i + columns]
+        row_buttons = [
+            InlineKeyboardButton(str(num), callback_data=f"selected_task_{num}_{page}{suffix}")
+            for num in row_numbers
+        ]
+        keyboard.append(row_buttons)
+    nav = page_buttons('pick', rows, has_prev, has_next, suffix)
+    if nav:
+        keyboard.append(nav)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def status_keyboard(task_id: int, page: int, suffix: str = ''):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(title, callback_data=f"status_{status}_{task_id}_{page}{suffix}") for title, status in row]
+        for row in STATUS_BUTTONS
+    ])
+
+
+class TaskViews:
+    """Отрисованные страницы списка задач вместе с клавиатурами.
+
+    Кэш сбрасывают add_task/change_status этого процесса и NOTIFY
+    от других инстансов бота.
+    """
+
+    def __init__(self, db, max_size: int = TASK_VIEW_CACHE_SIZE, page_size: int = TASKS_PAGE_SIZE):
+        self.db = db
+        self.max_size = max_size
+        self.page_size = page_size
+        self._views = OrderedDict()
+        # Отрисовка, начатая до сброса, не должна попасть в кэш после него
+        self.generation = 0
+
+    def invalidate(self, payload: str = None) -> None:
+        """payload - ключ области 'chat_id:thread_id', пустой - сбросить все"""
+        self.generation += 1
+        if not payload:
+            self._views.clear()
+            return
+        for key in [key for key in self._views if key[0] in (payload, 'all')]:
+            del self._views[key]
+
+    async def load_page(self, scope, direction: str = 'after', anchor: int = 0):
+        chat_id, thread_id = scope if scope is not None else (None, 0)
+        page = {'limit': self.page_size, 'chat_id': chat_id, 'thread_id': thread_id}
+        if direction == 'before':
+            rows, has_prev, has_next = await self.db.show_tasks_page(before_id=anchor, **page)
+        else:
+            rows, has_prev, has_next = await self.db.show_tasks_page(after_id=anchor, **page)
+        # Все задачи страницы могли завершить - возвращаемся к началу списка
+        if not rows and anchor:
+            rows, has_prev, has_next = await self.db.show_tasks_page(**page)
+        return rows, has_prev, has_next
+
+    async def view(self, scope, kind: str, direction: str = 'after', anchor: int = 0,
+                   task_id: int = None) -> Optional[TaskView]:
+        """scope - (chat_id, thread_id) или None для всех чатов.
+
+        kind: tasks - список, pick - выбор номера, status - выбор статуса. None - задач нет
+        """
+        key = ('all' if scope is None else task_scope_key(*scope), kind, direction, anchor, task_id)
+        if key in self._views:
+            self._views.move_to_end(key)
+            return self._views[key]
+
+        generation = self.generation
+        rows, has_prev, has_next = await self.load_page(scope, direction, anchor)
+        suffix = ALL_CHATS_SUFFIX if scope is None else ''
+
+        if not rows:
+            view = None
+        elif kind == 'tasks':
+            view = TaskView(render_tasks(rows), tasks_keyboard(rows, has_prev, has_next, suffix))
+        elif kind == 'pick':
+            view = TaskView(f"{render_tasks(rows)}\nВыбери номер задачи:", picker_keyboard(rows, has_prev, has_next, suffix))
+        else:
+            view = TaskView(f"{render_tasks(rows)}\nКакой статус поставим?", status_keyboard(task_id, anchor, suffix))
+
+        if generation == self.generation:
+            self._views[key] = view
+            if len(self._views) > self.max_size:
+                self._views.popitem(last=False)
+        return view
+
+
+task_views = TaskViews(db)
+db.on_tasks_changed(task_views.invalidate)
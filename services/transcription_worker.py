@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from telegram import Bot
+
+from database import db
+from services.media_worker import MediaSaver, media_extension
+from services.engines import transcription_engine
+from services.chunking import chunked_transcriber
+from services.scheduler import transcription_scheduler
+from services.metrics import registry, start_metrics_server
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout)  # Важно для Docker
+    ]
+)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv('TRANSCRIPTION_POLL_INTERVAL', '2'))
+VISIBILITY_TIMEOUT = int(os.getenv('TRANSCRIPTION_VISIBILITY_TIMEOUT', '600'))
+RETRY_DELAY = int(os.getenv('TRANSCRIPTION_RETRY_DELAY', '30'))
+WORKER_CONCURRENCY = int(os.getenv('TRANSCRIPTION_WORKER_CONCURRENCY', '1'))
+
+JOBS = registry.counter('transcription_jobs_total', 'Обработанные задания очереди транскрипций', ('result',))
+JOB_LATENCY = registry.histogram('transcription_job_seconds', 'Время задания: скачивание, распознавание, запись')
+
+
+class TranscriptionWorker:
+    """Забирает задания из bot_data.transcription_jobs и пишет текст в group_messages.
+
+    Процессов-воркеров может быть сколько угодно и на разных машинах:
+    задания разбираются через FOR UPDATE SKIP LOCKED.
+    """
+
+    def __init__(self, db, bot: Bot, media_saver: MediaSaver, worker_id: str, concurrency: int = WORKER_CONCURRENCY):
+        self.db = db
+        self.bot = bot
+        self.media_saver = media_saver
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        logger.info(f'🛑 {self.worker_id}: останавливаемся после текущих заданий')
+        self._stopping.set()
+
+    async def run(self):
+        logger.info(f'🔰 {self.worker_id}: воркер транскрипции запущен')
+        await asyncio.gather(*(self._loop() for _ in range(self.concurrency)))
+
+    async def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                await self.db.reap_transcription_jobs()
+                job = await self.db.claim_transcription_job(self.worker_id, VISIBILITY_TIMEOUT)
+            except Exception as e:
+                logger.error(f'❌ {self.worker_id}: не удалось получить задание: {e}')
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.process(job)
+
+    async def _heartbeat(self, job_id: int):
+        # Продлеваем видимость, пока идет длинная транскрипция
+        while True:
+            await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+            try:
+                await self.db.extend_transcription_job(job_id, self.worker_id, VISIBILITY_TIMEOUT)
+            except Exception as e:
+                logger.info(f'job {job_id}: не удалось продлить блокировку: {e}')
+
+    async def process(self, job: dict):
+        job_id = job['id']
+        ext = media_extension(job['media_type'], job['media_file_name'])
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        started = time.perf_counter()
+
+        logger.info({
+            "START": " 🔄",
+            "job_id": job_id,
+            "message_id": job['telegram_message_id'],
+            "attempt": job['attempts'],
+        })
+
+        try:
+            unique_id = job['media_file_unique_id']
+            if not await self.media_saver.apply_cached_transcript(unique_id, job['telegram_chat_id'], job['telegram_message_id']):
+                # Повторная попытка и пересланный файл берутся из хранилища, без скачивания
+                refetch = lambda: self.media_saver.fetch(
+                    lambda: self.bot.get_file(job['media_file_id']), unique_id, job['media_type'], ext,
+                    chat_id=job['telegram_chat_id'], message_id=job['telegram_message_id']
+                )
+                source = await refetch()
+                text = await self.media_saver.transcribe_async(source, job['media_duration'], refetch)
+                await self.media_saver.write_transcript(job['telegram_chat_id'], job['telegram_message_id'], text)
+                await self.media_saver.remember_transcript(unique_id, text)
+            await self.db.complete_transcription_job(job_id, self.worker_id)
+            JOBS.inc(result='done')
+            logger.info(f'✅job {job_id} message_id:{job["telegram_message_id"]} saved to database')
+        except Exception as e:
+            # Экспоненциальная задержка между попытками
+            retry_delay = RETRY_DELAY * 2 ** (job['attempts'] - 1)
+            logger.info(f'❌job {job_id} attempt {job["attempts"]}/{job["max_attempts"]} failed: {e}')
+            try:
+                await self.db.fail_transcription_job(job_id, self.worker_id, repr(e), retry_delay)
+            except Exception as db_error:
+                logger.error(f'❌job {job_id}: не удалось записать ошибку: {db_error}')
+            if job['attempts'] >= job['max_attempts']:
+                JOBS.inc(result='failed')
+                await self.media_saver.mark_transcript_failed(job['telegram_chat_id'], job['telegram_message_id'])
+            else:
+                JOBS.inc(result='retry')
+        finally:
+            JOB_LATENCY.observe(time.perf_counter() - started)
+            heartbeat.cancel()
+
+
+async def main():
+    bot = Bot(os.getenv('TOKEN'))
+    worker = TranscriptionWorker(db, bot, MediaSaver(db), worker_id=f'{socket.gethostname()}:{os.getpid()}')
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    # Воркер все равно будет транскрибировать: грузим модель до первого задания,
+    # чтобы загрузка не съедала visibility timeout
+    await transcription_engine.warm_up()
+    metrics_server = await start_metrics_server()
+
+    async with bot:
+        await worker.run()
+    await worker.media_saver.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    transcription_scheduler.close()
+    chunked_transcriber.close()
+    db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,16 +1,55 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from services.media_worker import MediaSaver
-from database import db
+from services.media_worker import MediaSaver, TRANSCRIBABLE_MEDIA_TYPES
+from services.scheduler import SchedulerFull
+from services.batcher import BatchWriter
+from database import db, MessageRow
+
+from typing import NamedTuple, Optional
 
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', '200'))
+MESSAGE_BATCH_INTERVAL_MS = int(os.getenv('MESSAGE_BATCH_INTERVAL_MS', '500'))
+
+# inline - транскрипция в процессе бота, queue - бот только ставит задание в transcription_jobs
+TRANSCRIPTION_MODE = os.getenv('TRANSCRIPTION_MODE', 'inline')
+TRANSCRIPTION_MAX_ATTEMPTS = int(os.getenv('TRANSCRIPTION_MAX_ATTEMPTS', '5'))
+
+# Сообщения из групп пишутся пачками: одно обращение к БД на N строк или M мс
+message_buffer = BatchWriter(
+    db.save_messages,
+    key=lambda row: (row.telegram_message_id, row.telegram_chat_id),
+    max_size=MESSAGE_BATCH_SIZE,
+    interval_ms=MESSAGE_BATCH_INTERVAL_MS,
+    name='group_messages'
+)
+
+
+class MediaInfo(NamedTuple):
+    """Медиа-колонки MessageRow, в том же порядке"""
+    media_type: Optional[str] = None
+    media_file_id: Optional[str] = None
+    media_file_unique_id: Optional[str] = None
+    media_file_name: Optional[str] = None
+    media_mime_type: Optional[str] = None
+    media_file_size: Optional[int] = None
+    media_duration: Optional[int] = None
+    media_width: Optional[int] = None
+    media_height: Optional[int] = None
+
+
+NO_MEDIA = MediaInfo()
+
+
 class MessageSaver:
 
     def __init__(self, db):
         self.db = db
+        self.media_saver = MediaSaver(db)
 
     async def save_group_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
 
@@ -32,15 +71,15 @@ class MessageSaver:
 
         message_data = self._extract_message_data(message)
 
-        # Сохраняем в БД
+        # Ставим в очередь на запись в БД
         try:
-            db.save_message(message_data)
-            logger.info(f"✅ Сообщение {message.message_id} сохранено в БД")
+            saved = message_buffer.add(message_data)
+            logger.info(f"✅ Сообщение {message.message_id} поставлено в очередь на запись")
 
-            # Если есть медиа - сохраняем отдельно
-            if message_data['has_media']:
+            # Если есть медиа - сохраняем отдельно, не держа очередь апдейтов чата
+            if message_data.has_media:
                 logger.info(f"✅ Сообщение {message.message_id} это MEDIA file'")
-                await MediaSaver(db).save_group_media(update, context)
+                context.application.create_task(self._save_media(saved, message_data, update, context), update=update)
 
             return True
 
@@ -48,104 +87,93 @@ class MessageSaver:
             print(f"❌ Ошибка сохранения сообщения: {e}")
             return False
 
-    def _extract_message_data(self, message) -> dict:
-        """Извлекает ВСЕ данные из сообщения"""
-
-        # ВАЖНО: Все поля из SQL запроса должны быть здесь!
-        data = {
-            # Основные идентификаторы
-            'telegram_message_id': message.message_id,
-            'telegram_chat_id': message.chat.id,
-            'telegram_thread_id': message.message_thread_id or 0,
-
-            # Отправитель
-            'sender_user_id': message.from_user.id,
-            'sender_username': message.from_user.username,
-            'sender_first_name': message.from_user.first_name,
-            'sender_last_name': message.from_user.last_name or '',
-            'sender_is_bot': message.from_user.is_bot,
-            'sender_language_code': message.from_user.language_code or 'ru',
-
-            # Чат
-            'chat_type': message.chat.type,
-            'chat_title': message.chat.title or '',
-            'chat_is_forum': message.chat.is_forum if hasattr(message.chat, 'is_forum') else False,
-
-            # Сообщение
-            'message_type': 'text',
-            'message_text': message.text or message.caption or '',
-
-            # Медиа поля (все должны быть!)
-            'has_media': False,
-            'media_type': None,
-            'media_file_id': None,
-            'media_file_unique_id': None,
-            'media_file_name': None,
-            'media_mime_type': None,
-            'media_file_size': None,
-            'media_duration': None,
-            'media_width': None,
-            'media_height': None,
-
-            # Флаги состояния
-            'is_topic_message': message.is_topic_message,
-            'is_forwarded': False,  # ← ДОБАВИЛ ЭТО!
-            'is_reply': False,
-
-            # Ответы
-            'reply_to_message_id': None,
-            'reply_to_user_id': None,
+    async def _save_media(self, saved, message_data: MessageRow, update: Update,
+                          context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Фоном: дожидается записи строки и запускает транскрипцию (очередь БД или сразу)"""
+        chat_id, message_id = message_data.telegram_chat_id, message_data.telegram_message_id
+        try:
+            # Транскрипция обновляет строку, поэтому она должна уже быть в БД
+            await saved
+            if TRANSCRIPTION_MODE == 'queue' and message_data.media_type in TRANSCRIBABLE_MEDIA_TYPES:
+                if not await self.media_saver.apply_cached_transcript(message_data.media_file_unique_id, chat_id, message_id):
+                    await self._enqueue_transcription(message_data)
+            else:
+                try:
+                    await self.media_saver.save_group_media(update, context)
+                except SchedulerFull:
+                    # Планировщик так и не освободился: запись дождется воркера очереди, а не станет failed
+                    logger.info(f"⚠️ Сообщение {message_id}: планировщик переполнен, отдаем в очередь транскрипции")
+                    await self._enqueue_transcription(message_data)
+        except Exception as e:
+            logger.error(f"❌ Сообщение {message_id}: медиа не обработано: {e}")
 
-            # Форум
-            'forum_topic_name': None,
-            'forum_topic_icon_color': None,
+    async def _enqueue_transcription(self, message_data: MessageRow) -> None:
+        chat_id, message_id = message_data.telegram_chat_id, message_data.telegram_message_id
+        try:
+            await db.enqueue_transcription(message_data, max_attempts=TRANSCRIPTION_MAX_ATTEMPTS)
+        except Exception as e:
+            # Без задания строку никто не дообработает: не оставляем ее в pending
+            logger.error(f"❌ Сообщение {message_id}: не удалось поставить в очередь транскрипции: {e}")
+            await self.media_saver.mark_transcript_failed(chat_id, message_id)
+            return
+        logger.info(f"📥 Сообщение {message_id} поставлено в очередь транскрипции")
 
-            # Пересылки
-            'forward_from_user_id': None,
-            'forward_from_user_name': None,
-            'forward_date': None,
+    def _extract_message_data(self, message) -> MessageRow:
+        """Извлекает ВСЕ данные из сообщения"""
 
-            # Время
-            'telegram_date': message.date,
-        }
+        user = message.from_user
+        chat = message.chat
 
         # Определяем тип сообщения
         message_type = self._determine_message_type(message)
-        data['message_type'] = message_type
 
         # Если есть медиа
-        if message_type != 'text':
-            media_info = self._extract_media_info(message)
-            if media_info:
-                data.update(media_info)
-                data['has_media'] = True
+        media = self._extract_media_info(message) if message_type != 'text' else None
+        # Текст запишет транскрипция, до тех пор строка ждет
+        transcript_status = 'pending' if media and media.media_type in TRANSCRIBABLE_MEDIA_TYPES else None
 
         # Проверяем пересланные сообщения
-        if message.forward_from or message.forward_from_chat:
-            data['is_forwarded'] = True
-            if message.forward_from:
-                data['forward_from_user_id'] = message.forward_from.id
-                data['forward_from_user_name'] = message.forward_from.username or message.forward_from.first_name
-            if message.forward_date:
-                data['forward_date'] = message.forward_date
+        forward_from = message.forward_from
+        is_forwarded = bool(forward_from or message.forward_from_chat)
+        forward_date = message.forward_date if is_forwarded else None
 
         # Проверяем ответ
-        if message.reply_to_message:
-            data['is_reply'] = True
-            data['reply_to_message_id'] = message.reply_to_message.message_id
-            data[
-                'reply_to_user_id'] = message.reply_to_message.from_user.id if message.reply_to_message.from_user else None
+        reply = message.reply_to_message
 
         # Форум топик
-        if message.reply_to_message and hasattr(message.reply_to_message, 'forum_topic_created'):
-            if message.reply_to_message.forum_topic_created:
-                data['forum_topic_name'] = message.reply_to_message.forum_topic_created.name
-                data['forum_topic_icon_color'] = message.reply_to_message.forum_topic_created.icon_color
+        topic = getattr(reply, 'forum_topic_created', None) if reply else None
+        if reply and hasattr(reply, 'forum_topic_created'):
+            forum_topic_name = topic.name if topic else None
+            forum_topic_icon_color = topic.icon_color if topic else None
+            is_topic_message = message.is_topic_message
         else:
-            data['forum_topic_name'] = 'General'
-            data['is_topic_message'] = True
+            forum_topic_name, forum_topic_icon_color, is_topic_message = 'General', None, True
 
-        return data
+        # Порядок аргументов - порядок полей MessageRow
+        return MessageRow(
+            # Основные идентификаторы
+            message.message_id, chat.id, message.message_thread_id or 0,
+            # Отправитель
+            user.id, user.username, user.first_name, user.last_name or '', user.is_bot, user.language_code or 'ru',
+            # Чат
+            chat.type, chat.title or '', getattr(chat, 'is_forum', False),
+            # Сообщение
+            message_type, message.text or message.caption or '',
+            # Медиа
+            media is not None, *(media or NO_MEDIA),
+            # Флаги состояния
+            is_topic_message, reply is not None, is_forwarded,
+            # Ответы
+            reply.message_id if reply else None, reply.from_user.id if reply and reply.from_user else None,
+            # Форум
+            forum_topic_name, forum_topic_icon_color,
+            # Пересылки
+            forward_from.id if forward_from else None,
+            (forward_from.username or forward_from.first_name) if forward_from else None,
+            forward_date,
+            # Время
+            message.date, transcript_status,
+        )
 
     def _determine_message_type(self, message):
         """Определяет тип сообщения"""
@@ -177,68 +205,74 @@ class MessageSaver:
             return 'unknown'
 
     def _extract_media_info(self, message):
-        """Извлекает информацию о медиа"""
-        info = {}
+        """Извлекает информацию о медиа: None, если медиа нет"""
 
         if message.photo:
             # Берем самую большую фотографию
             photo = message.photo[-1]
-            info.update({
-                'media_type': 'photo',
-                'media_file_id': photo.file_id,
-                'media_file_unique_id': photo.file_unique_id,
-                'media_file_size': photo.file_size,
-                'media_width': photo.width,
-                'media_height': photo.height
-            })
+            return MediaInfo(
+                media_type='photo',
+                media_file_id=photo.file_id,
+                media_file_unique_id=photo.file_unique_id,
+                media_file_size=photo.file_size,
+                media_width=photo.width,
+                media_height=photo.height
+            )
         elif message.voice:
-            info.update({
-                'media_type': 'voice',
-                'media_file_id': message.voice.file_id,
-                'media_file_unique_id': message.voice.file_unique_id,
-                'media_file_size': message.voice.file_size,
-                'media_duration': message.voice.duration,
-                'media_mime_type': message.voice.mime_type
-            })
+            return MediaInfo(
+                media_type='voice',
+                media_file_id=message.voice.file_id,
+                media_file_unique_id=message.voice.file_unique_id,
+                media_file_size=message.voice.file_size,
+                media_duration=message.voice.duration,
+                media_mime_type=message.voice.mime_type
+            )
         elif message.document:
-            info.update({
-                'media_type': 'document',
-                'media_file_id': message.document.file_id,
-                'media_file_unique_id': message.document.file_unique_id,
-                'media_file_size': message.document.file_size,
-                'media_file_name': message.document.file_name,
-                'media_mime_type': message.document.mime_type
-            })
+            return MediaInfo(
+                media_type='document',
+                media_file_id=message.document.file_id,
+                media_file_unique_id=message.document.file_unique_id,
+                media_file_size=message.document.file_size,
+                media_file_name=message.document.file_name,
+                media_mime_type=message.document.mime_type
+            )
         elif message.video:
-            info.update({
-                'media_type': 'video',
-                'media_file_id': message.video.file_id,
-                'media_file_unique_id': message.video.file_unique_id,
-                'media_file_size': message.video.file_size,
-                'media_duration': message.video.duration,
-                'media_width': message.video.width,
-                'media_height': message.video.height,
-                'media_mime_type': message.video.mime_type
-            })
+            return MediaInfo(
+                media_type='video',
+                media_file_id=message.video.file_id,
+                media_file_unique_id=message.video.file_unique_id,
+                media_file_size=message.video.file_size,
+                media_duration=message.video.duration,
+                media_width=message.video.width,
+                media_height=message.video.height,
+                media_mime_type=message.video.mime_type
+            )
         elif message.audio:
-            info.update({
-                'media_type': 'audio',
-                'media_file_id': message.audio.file_id,
-                'media_file_unique_id': message.audio.file_unique_id,
-                'media_file_size': message.audio.file_size,
-                'media_duration': message.audio.duration,
-                'media_mime_type': message.audio.mime_type,
-                'media_file_name': message.audio.file_name or message.audio.title
-            })
+            return MediaInfo(
+                media_type='audio',
+                media_file_id=message.audio.file_id,
+                media_file_unique_id=message.audio.file_unique_id,
+                media_file_size=message.audio.file_size,
+                media_duration=message.audio.duration,
+                media_mime_type=message.audio.mime_type,
+                media_file_name=message.audio.file_name or message.audio.title
+            )
+        elif message.video_note:
+            return MediaInfo(
+                media_type='video_note',
+                media_file_id=message.video_note.file_id,
+                media_file_unique_id=message.video_note.file_unique_id,
+                media_file_size=message.video_note.file_size,
+                media_duration=message.video_note.duration,
+                media_width=message.video_note.length,
+                media_height=message.video_note.length
+            )
         elif message.sticker:
-            info.update({
-                'media_type': 'sticker',
-                'media_file_id': message.sticker.file_id,
-                'media_file_unique_id': message.sticker.file_unique_id,
-                'media_file_size': message.sticker.file_size
-            })
-
-        return info if info else None
-
-
-
+            return MediaInfo(
+                media_type='sticker',
+                media_file_id=message.sticker.file_id,
+                media_file_unique_id=message.sticker.file_unique_id,
+                media_file_size=message.sticker.file_size
+            )
+
+        return None
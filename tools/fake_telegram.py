@@ -0,0 +1,279 @@
+"""Поддельный Telegram для локальных прогонов webhook-режима.
+
+Поднимает Bot API на http://127.0.0.1:8081 (запросы бота отвечаются
+правдоподобными заглушками) и шлет апдейты POST'ом в webhook одной
+или нескольких реплик бота, как это делает Telegram.
+
+    python tools/fake_telegram.py --webhook http://127.0.0.1:8443/telegram --secret s3cret
+
+Бот запускается с
+    BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_SECRET=s3cret \
+        TELEGRAM_BASE_URL=http://127.0.0.1:8081
+
+Несколько --webhook обходятся по кругу, поэтому апдейты одного чата попадают
+в разные реплики. Порядок сообщений в чате гарантирован только внутри одной
+реплики: между репликами его ничто не держит, а в compose нет липкой
+маршрутизации по чату.
+
+Только стандартная библиотека.
+"""
+import argparse
+import io
+import itertools
+import json
+import math
+import random
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import wave
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USERNAME = 'fake_task_bot'
+CHAT_ID = -1001000000001
+USERS = [
+    {'id': 1000 + i, 'is_bot': False, 'first_name': f'User{i}', 'username': f'user{i}'}
+    for i in range(10)
+]
+
+
+def voice_sample(seconds: float = 2.0, sr: int = 16000) -> bytes:
+    """WAV с тоном: ffmpeg определяет формат по содержимому, а не по расширению"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(sr)
+        out.writeframes(b''.join(
+            struct.pack('<h', int(8000 * math.sin(2 * math.pi * 440 * i / sr)))
+            for i in range(int(seconds * sr))
+        ))
+    return buffer.getvalue()
+
+
+class FakeBotApi:
+    """Состояние поддельного Bot API: счетчики вызовов и id отправленных сообщений"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.message_ids = itertools.count(1_000_000)
+        self.voice = voice_sample()
+        self.lock = threading.Lock()
+
+    def message(self, chat_id, text=None, **extra):
+        return dict({
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'supergroup', 'title': 'Fake chat'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': BOT_USERNAME},
+            'text': text or '',
+        }, **extra)
+
+    def call(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': BOT_USERNAME,
+                    'can_join_groups': True, 'can_read_all_group_messages': True,
+                    'supports_inline_queries': False}
+        if method in ('sendMessage', 'editMessageText'):
+            return self.message(params.get('chat_id', CHAT_ID), params.get('text'))
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'][-8:],
+                    'file_size': len(self.voice), 'file_path': f'voice/{params["file_id"]}.ogg'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        # setWebhook, deleteWebhook, answerCallbackQuery и прочее
+        return True
+
+
+def make_handler(api: FakeBotApi):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes, content_type: str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self) -> dict:
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode() if length else ''
+            if not raw:
+                return {}
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                return json.loads(raw)
+            # python-telegram-bot шлет form-urlencoded, сложные значения - JSON-строками
+            params = {}
+            for key, value in parse_qsl(raw):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            return params
+
+        def do_GET(self):
+            if self.path.startswith('/file/'):
+                self._reply(200, api.voice, 'application/octet-stream')
+            else:
+                self.do_POST()
+
+        def do_POST(self):
+            # /bot<token>/<method>
+            parts = self.path.strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self._reply(404, b'{"ok": false, "description": "Not Found"}')
+                return
+            result = api.call(parts[1], self._params())
+            self._reply(200, json.dumps({'ok': True, 'result': result}).encode())
+
+    return Handler
+
+
+class UpdateFactory:
+    """Апдейты групповой переписки: текст, задачи боту, /tasks, голосовые, кнопки"""
+
+    KINDS = ('text', 'text', 'text', 'task', 'tasks', 'voice', 'callback')
+
+    def __init__(self, chats: int):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chat_ids = [CHAT_ID - i for i in range(chats)]
+
+    def _message(self, user, chat_id, **content):
+        return dict({
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'},
+            'from': user,
+        }, **content)
+
+    def next(self) -> dict:
+        kind = random.choice(self.KINDS)
+        user = random.choice(USERS)
+        chat_id = random.choice(self.chat_ids)
+        update = {'update_id': next(self.update_ids)}
+
+        if kind == 'task':
+            executor = random.choice(USERS)['username']
+            text = f'@{BOT_USERNAME} проверить отчет @{executor}'
+            update['message'] = self._message(user, chat_id, text=text, entities=[
+                {'type': 'mention', 'offset': 0, 'length': len(BOT_USERNAME) + 1},
+                {'type': 'mention', 'offset': text.rindex('@'), 'length': len(executor) + 1},
+            ])
+        elif kind == 'tasks':
+            update['message'] = self._message(user, chat_id, text='/tasks', entities=[
+                {'type': 'bot_command', 'offset': 0, 'length': 6},
+            ])
+        elif kind == 'voice':
+            file_id = f'voice{update["update_id"]:08d}'
+            update['message'] = self._message(user, chat_id, voice={
+                'file_id': file_id, 'file_unique_id': file_id[-8:], 'duration': 2,
+                'mime_type': 'audio/ogg', 'file_size': 64000,
+            })
+        elif kind == 'callback':
+            message = self._message(USERS[0], chat_id, text='список задач')
+            message['from'] = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': BOT_USERNAME}
+            update['callback_query'] = {
+                'id': str(update['update_id']), 'from': user, 'chat_instance': str(chat_id),
+                'message': message, 'data': 'tasks_after_0',
+            }
+        else:
+            update['message'] = self._message(user, chat_id, text=f'сообщение {update["update_id"]}')
+        return update
+
+
+def deliver(url: str, secret: str, update: dict, timeout: float = 10):
+    """POST апдейта как у Telegram: (HTTP-статус, секунды)"""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret or ''},
+        method='POST',
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Поддельный Telegram: Bot API и доставка апдейтов в webhook')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--webhook', action='append', default=[],
+                        help='URL webhook реплики; несколько - раздаются по кругу, как балансировщиком')
+    parser.add_argument('--secret', default='', help='X-Telegram-Bot-Api-Secret-Token')
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=20, help='апдейтов в секунду, 0 - без паузы')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=3)
+    parser.add_argument('--duplicates', type=float, default=0.1,
+                        help='доля апдейтов, доставляемых повторно на другую реплику')
+    parser.add_argument('--serve', action='store_true', help='после отправки не выходить, а обслуживать Bot API')
+    args = parser.parse_args()
+
+    api = FakeBotApi()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Fake Bot API: http://{args.host}:{args.port}')
+
+    if args.webhook:
+        # Бот должен успеть подняться и спросить getMe
+        time.sleep(1)
+        factory = UpdateFactory(args.chats)
+        replicas = itertools.cycle(args.webhook)
+        statuses = Counter()
+        latencies = []
+
+        def send(url, update):
+            status, seconds = deliver(url, args.secret, update)
+            statuses[status] += 1
+            latencies.append(seconds)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for _ in range(args.updates):
+                update = factory.next()
+                pool.submit(send, next(replicas), update)
+                if random.random() < args.duplicates:
+                    pool.submit(send, next(replicas), update)
+                if args.rate:
+                    time.sleep(1 / args.rate)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        print(f'Доставлено {sum(statuses.values())} POST за {elapsed:.1f} c, статусы: {dict(statuses)}')
+        if latencies:
+            print(f'Ответ webhook: p50 {latencies[len(latencies) // 2] * 1000:.0f} мс, '
+                  f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f} мс')
+        # Ответы бота приходят асинхронно, после 200 на webhook
+        time.sleep(2)
+        print(f'Вызовы Bot API: {dict(api.calls)}')
+
+    if args.serve or not args.webhook:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()